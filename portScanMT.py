@@ -4,30 +4,34 @@
 
 
 import ipaddress
-import re
 import sys
 import socket
-import argparse
-from multiprocessing.pool import ThreadPool
 import time
+import scanAddress
+import scanInput
+import scanMain
+import scanResolver
+import scanSchedule
+import scanSocket
+import scanTiming
 
 
 # Method to get IPs from IP range
-# Args: start - IPv4 sting of form XXX.XXX.XXX.XXX
+# Args: start - IPv4 sting of form XXX.XXX.XXX.XXX, or IPv6 address
 #       end - ""
 def getIPRange(start,end):
     # Convert first and last IP into integers 
-    startInt = int(ipaddress.ip_address(start).packed.hex(), 16)
-    endInt = int(ipaddress.ip_address(end).packed.hex(), 16)
-    # Interate over range of ints repacking back into IP stings
-    return [ipaddress.ip_address(ip).exploded for ip in range(startInt,endInt)]
+    startInt = scanAddress.toNumber(start)
+    endInt = scanAddress.toNumber(end)
+    # Lazily interate over range of ints repacking back into IP stings
+    return (scanAddress.toAddress(ip) for ip in range(startInt,endInt))
 
 # Method to get IPs from subnet
 # Method to get IPs from subnet
-# Args: subnet - A string denoting a IPv4 subnet of form XXX.XXX.XXX.XXX/XX
+# Args: subnet - A string denoting a IPv4 subnet of form XXX.XXX.XXX.XXX/XX, or an IPv6 subnet
 def getSubnetRange(subnet):
-    # Iterate over all IP in supplied subnet
-    return [str(ip) for ip in ipaddress.IPv4Network(subnet,False)]
+    # Lazily iterate over all IP in supplied subnet
+    return (str(ip) for ip in ipaddress.ip_network(subnet,False))
 
 
 # Method to perform port test
@@ -36,16 +40,27 @@ def getSubnetRange(subnet):
 #       port - Int of for port used for connection
 #       timout - Int Seconds to wait before colosing socket without reply
 def testPort(request,host,port,timeout):
-    # Create new TCP socket for connection
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Set Timout value on socket to user supplied seconds
+    # Look up the address resolved ahead of the scan
+    address = scanResolver.getAddress(host)
+    # Report hostnames that could not be resolved without opening a socket
+    if address == None:
+        return [request, host, port, "Hostname could not be resolved"]
+    # Create new TCP socket for connection, IPv4 or IPv6 as the address is
+    try:
+        sock = scanSocket.SOCKETS.open(scanAddress.family(address))
+    # Running out of file descriptors or source ports is reported like any other error
+    except socket.error as msg:
+        return [request, host, port, msg]
+    # Set Timout value on socket to user supplied seconds, or the adaptive
+    # timeout of the target subnet capped at that value
     if timeout != None:
-        sock.settimeout(timeout)
+        sock.settimeout(scanTiming.RTT.timeout(address,timeout))
     else:
-        sock.settimeout(10)
+        sock.settimeout(scanTiming.RTT.timeout(address,10))
+    start = time.monotonic()
     try:
         # Attempt Socket connection on host and port
-        result = sock.connect((host,int(port)))
+        result = sock.connect((address,int(port)))
         # If connection was successful:
         if result == None:
             result = " LISTENING"
@@ -61,101 +76,100 @@ def testPort(request,host,port,timeout):
     # Collect and print any other error
     except socket.error as msg:
         result = msg
-    # Close socket and end connection
-    sock.close()
+    # Feed the round trip time of answered connects to the adaptive timeouts
+    if result == " LISTENING" or result == "NOT LISTENING":
+        scanTiming.RTT.sample(address,time.monotonic() - start)
+    # Close socket and end connection, with a RST if fast close is on
+    scanSocket.SOCKETS.close(sock,result == " LISTENING")
     # Return results
     return [request, host, port, result]
 
-# Method to export as csv
-# Args: resultList - List of all results from the pool run
-#       outFile - File name for output csv
-def csvExport(resultList,outFile):
-    # Write header for file
-    csvOut = "Request, Destination, Port, Result\n"
-    # Loop through resultDict collecting values for csv
-    for result in resultList:
-        csvOut = csvOut + "{0},{1},{2},{3}\n".format(*result)
-    # write csv
-    outFile = open(outFile,"w")
-    outFile.write(csvOut)
-    outFile.close()
+# Header line for output csv
+CSV_HEADER = "Request, Destination, Port, Result\n"
+# Header line for output csv with banners
+BANNER_HEADER = "Request, Destination, Port, Result, Detected Service, Banner\n"
 
-# Method to create list of all connections that need to be tested
+# Generator of all connections that need to be tested
 # Args: inList - list of split lines from input csv
 def getDestList(inList):
-    destList = []
     # Loop through all input lines
     for inValue in inList:
         # Frist value is hostname, IP, IP range, or subnet to test
         host = inValue[0]
-        # Split list of ports
-        ports = inValue[1].split(",")
+        # Split list of ports, keeping ranges such as 1-1024 compact
+        ports = scanInput.parsePorts(inValue[1],",")
+        # If input is a hitlist file of addresses
+        if scanInput.isHitlist(host):
+            for ip in scanInput.getHitlist(host):
+                for port in ports:
+                    yield [host,ip,port]
         # If input is range of IPs
-        if bool(re.search(r"\d+-\d+", host)):
+        elif bool(scanInput.RANGE.search(host)):
             # Split start and end addesses
             tempSplit = host.split("-")
             ipList = getIPRange(tempSplit[0],tempSplit[1])
             for ip in ipList:
                 for port in ports:
-                    destList.append([host,ip,port])
+                    yield [host,ip,port]
         # If input is a subnet
-        elif bool(re.search(r"\d+\/\d+",host)):
+        elif bool(scanInput.SUBNET.search(host)):
             ipList = getSubnetRange(host)
             for ip in ipList:
                 for port in ports:
-                    destList.append([host,ip,port])
+                    yield [host,ip,port]
         # If input is a single IP or hostname
         else:
             for port in ports:
-                destList.append([host,host,port])
-    return destList
+                yield [host,host,port]
+
+# Method to get the address interval and ports of every input line
+# Intervals are inclusive scanAddress numbers, a hostname line has the hostname as both ends
+# and a hitlist line has its Hitlist as the start
+# Args: inList - list of split lines from input csv
+def getIntervals(inList):
+    intervals = []
+    for inValue in inList:
+        host = inValue[0]
+        ports = scanInput.parsePorts(inValue[1],",")
+        otherInfo = []
+        # If input is a hitlist file, the addresses stand in for the interval
+        if scanInput.isHitlist(host):
+            start = scanInput.getHitlist(host)
+            end = None
+        # If input is range of IPs
+        elif bool(scanInput.RANGE.search(host)):
+            tempSplit = host.split("-")
+            start = scanAddress.toNumber(tempSplit[0])
+            end = scanAddress.toNumber(tempSplit[1]) - 1
+        # If input is a subnet
+        elif bool(scanInput.SUBNET.search(host)):
+            subnet = ipaddress.ip_network(host,False)
+            start = scanAddress.toNumber(str(subnet.network_address))
+            end = start + subnet.num_addresses - 1
+        # If input is a single IP or hostname
+        else:
+            start = end = scanAddress.toNumber(host)
+            if start == None:
+                start = end = host
+        intervals.append((host,start,end,ports,otherInfo))
+    return intervals
+
+# Method to count the connections getDestList will generate
+# Args: inList - list of split lines from input csv
+def countDestList(inList):
+    return sum(scanSchedule.countTests(interval) for interval in getIntervals(inList))
+
+# Method to pack a test into the testPort arguments
+# Args: test - [request, host, port] + otherInfo from getDestList
+#       timeout - Number of seconds to wait with no reply
+def testArgs(test,timeout):
+    return tuple(test + [timeout])
 
 # Script Start Piont:
 if __name__ == "__main__":
-    # Collect start time of script
-    startTime = time.time()
-    # Parse CMD line args
-    parser = argparse.ArgumentParser(description='A lightweight Multi-Threaded port scanner in python')
-    parser.add_argument('input',help='Formated Input File')
-    parser.add_argument('output',help='Output File (CSV)')
-    parser.add_argument("-t","--timeout",help='Timeout to wait for reply (Seconds). Default 10 Seconds',type=int)
-    parser.add_argument("-p","--poolsize",help='Size of muti-threaded pool. Default 5 threads',type=int)
-    args = parser.parse_args()
-    inFile = args.input
-    outFile = args.output
-    timeout = args.timeout
-    poolsize = args.poolsize
-
-    # Read from input file
-    destFile = open(inFile,"r")
-    inList = []
-    for count,line in enumerate(destFile, start=1):
-        # Pull out bad chars:
-        line = ''.join(c for c in line if 0 < ord(c) < 127)
-        # Remove new line and spaces then split between IP/Hostname and ports
-        split1 = line.rstrip('\n').split(" ")
-        # Test line meets expected format
-        if len(split1) != 2 :
-            print("ERROR at line " + str(count) + ":[" + line + "]. Skipping. Use -h option for more info", file=sys.stderr)
-        else:
-            inList.append([split1[0],split1[1]])
-    # Create list of all destination connections
-    destList = getDestList(inList)
-    resultsList = []
-    # Create execution pool to test all connections with user supplied number of threads
-    if poolsize != None:
-        pool = ThreadPool(poolsize)
-    else:
-        pool = ThreadPool(5)
-    # Add and run all connections in pool
-    for test in destList:
-        resultsList.append(pool.apply_async(testPort, args=tuple(test + [timeout])))
-    # End pool
-    pool.close()
-    pool.join()
-    resultsList = [i.get() for i in resultsList]
-    # Collect results from pool
-    csvExport(resultsList,outFile)
-    # Report execution time
-    execTime = time.time() - startTime
-    print("Execution Time {:.2f} Seconds".format(execTime))
+    # Report a line that does not meet the expected format
+    def badLine(count,line,reason):
+        print("ERROR at line " + str(count) + ":[" + line + "]: " + reason + ". Skipping. Use -h option for more info", file=sys.stderr)
+    # Read from input file, keeping port ranges compact. The command line, scan
+    # options and scan pipeline are shared with the other script in scanMain
+    scanMain.main("portScanMT",'A lightweight Multi-Threaded port scanner in python',",",lambda inFile: list(scanInput.loadTargets(inFile,badLine)))
@@ -0,0 +1,79 @@
+# Author: Brenden Sweetman
+# Title: scanAddress
+# Description: IPv4 and IPv6 address numbers, packing and socket families shared by the scanners
+
+
+import socket
+
+
+# IPv6 address numbers are offset past every IPv4 one, so both families share
+# one integer space and a range or subnet of either is a plain interval
+V6_OFFSET = 1 << 128
+# Prefix of an IPv4 address kept in 16 byte IPv6 storage (::ffff:0:0/96)
+V4_MAPPED = bytes(10) + b"\xff\xff"
+# Default prefix length of the IPv6 subnets sharing per subnet state, as a /24 does for IPv4
+PREFIX6 = 64
+
+
+# Method to get the address number of a host, None if it is a hostname
+# Args: host - String of Hostname, IPv4 or IPv6 address
+def toNumber(host):
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, host), "big")
+    except OSError:
+        pass
+    try:
+        return V6_OFFSET + int.from_bytes(socket.inet_pton(socket.AF_INET6, host), "big")
+    except OSError:
+        return None
+
+# Method to turn an address number back into its string
+# Args: number - Int from toNumber
+def toAddress(number):
+    if number >= V6_OFFSET:
+        return socket.inet_ntop(socket.AF_INET6, (number - V6_OFFSET).to_bytes(16, "big"))
+    return socket.inet_ntoa(number.to_bytes(4, "big"))
+
+# Method to test if a host is an IPv4 or IPv6 address
+# Args: host - String of Hostname or IP
+def isAddress(host):
+    return toNumber(host) != None
+
+# Method to test if an address number is IPv6
+# Args: number - Int from toNumber
+def isV6(number):
+    return number >= V6_OFFSET
+
+# Method to get the socket family of an address
+# Args: address - String of IPv4 or IPv6 address
+def family(address):
+    return socket.AF_INET6 if ":" in address else socket.AF_INET
+
+# Method to pack an address into 16 bytes, IPv4 as ::ffff:a.b.c.d, None if the host is a hostname
+# Args: host - String of Hostname or IP
+def pack(host):
+    try:
+        return V4_MAPPED + socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        pass
+    try:
+        return socket.inet_pton(socket.AF_INET6, host)
+    except OSError:
+        return None
+
+# Method to turn 16 packed bytes back into an address string
+# Args: packed - Bytes from pack
+def unpack(packed):
+    if packed[:12] == V4_MAPPED:
+        return socket.inet_ntoa(packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+# Method to get the key of the subnet holding an address number
+# Args: number - Int from toNumber
+#       prefix - Prefix length of IPv4 subnets
+#       prefix6 - Prefix length of IPv6 subnets. Default PREFIX6
+def subnetOf(number,prefix,prefix6=PREFIX6):
+    # Keys of the two families can not meet, as IPv6 numbers keep their offset
+    if number >= V6_OFFSET:
+        return number >> (128 - prefix6)
+    return number >> (32 - prefix)
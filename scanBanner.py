@@ -0,0 +1,232 @@
+# Author: Brenden Sweetman
+# Title: scanBanner
+# Description: Banner grab and service identification stage for LISTENING ports
+
+
+import re
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import scanAddress
+import scanResolver
+import scanSocket
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+
+# Default number of banner grabs in flight
+POOLSIZE = 32
+# Default seconds one banner grab may take, from connect to the last byte read
+TIMEOUT = 3
+# Max seconds to wait for a service that talks first before sending a probe,
+# at most half the time of the grab
+PASSIVE_WAIT = 1
+# Seconds to wait for more of a reply once it has started
+READ_GAP = 0.25
+# Max bytes read from a service
+MAX_BANNER = 2048
+# Max bytes of the banner written to the output
+BANNER_CHARS = 160
+# Number of grabs allowed to wait per grab in flight before the connect engines are held up
+QUEUE_DEPTH = 64
+# Max seconds a connect engine is held up waiting for a free grab. Grabs end
+# within their own timeout, so this is only reached if the pool is stuck
+QUEUE_WAIT = 60
+# Service written for a LISTENING port whose grab was skipped
+SKIPPED = "skipped"
+
+HTTP_PROBE = b"HEAD / HTTP/1.0\r\n\r\n"
+SSH_PROBE = b"SSH-2.0-portScan\r\n"
+
+
+# Method to build a TLS ClientHello with the ssl module
+# Returns empty bytes where ssl is not available
+def clientHello():
+    if ssl == None:
+        return b""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    outgoing = ssl.MemoryBIO()
+    tls = context.wrap_bio(ssl.MemoryBIO(),outgoing)
+    # The handshake stops waiting for the server, leaving the hello to send
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+TLS_PROBE = clientHello()
+
+# Probe sent at once to well known ports. Other ports get a moment to talk
+# first, then HTTP_PROBE
+PORT_PROBES = {port: probe for ports,probe in (
+    ((22, 2222), SSH_PROBE),
+    ((80, 81, 591, 3000, 5000, 8000, 8008, 8080, 8081, 8888), HTTP_PROBE),
+    ((443, 465, 636, 853, 993, 995, 2376, 6443, 8443, 9443), TLS_PROBE),
+) for port in ports}
+
+# Service signatures tried in order on the start of a reply
+# A version group is added to the service name
+SIGNATURES = [(service, re.compile(pattern, re.DOTALL)) for service,pattern in (
+    ("ssh", rb"SSH-[\d.]+-(?P<version>[^\r\n ]+)"),
+    ("http", rb"HTTP/[\d.]+ \d{3}(?:.*?\r?\n(?i:server): *(?P<version>[^\r\n]+))?"),
+    ("tls", rb"\x16\x03[\x00-\x04]..\x02"),
+    ("tls", rb"\x15\x03[\x00-\x04]\x00\x02"),
+    ("smtp", rb"220[- ](?P<version>[^\r\n]*(?:SMTP|Postfix|Exim|Sendmail)[^\r\n]*)"),
+    ("ftp", rb"220[- ](?P<version>[^\r\n]*)"),
+    ("pop3", rb"\+OK"),
+    ("imap", rb"\* (?:OK|PREAUTH)"),
+    ("mysql", rb"...\x00\x0a(?P<version>[\d.]+[^\x00]*)\x00"),
+    ("vnc", rb"RFB (?P<version>\d{3}\.\d{3})"),
+    ("redis", rb"-(?:ERR|NOAUTH|DENIED)"),
+    ("telnet", rb"\xff[\xfb-\xfe]"),
+)]
+
+
+# Method to read a reply until it stops, the deadline passes or MAX_BANNER bytes
+# Args: sock - Connected socket
+#       deadline - time.monotonic() to stop waiting at
+def readBanner(sock,deadline):
+    data = b""
+    wait = deadline - time.monotonic()
+    while len(data) < MAX_BANNER and wait > 0:
+        sock.settimeout(wait)
+        try:
+            chunk = sock.recv(MAX_BANNER - len(data))
+        except OSError:
+            break
+        if not chunk:
+            break
+        data += chunk
+        # Once the reply has started only wait a moment for the rest of it
+        wait = min(deadline - time.monotonic(), READ_GAP)
+    return data
+
+# Method to name the service that sent a reply
+# Args: data - Bytes of the reply
+def identify(data):
+    for service,pattern in SIGNATURES:
+        match = pattern.match(data)
+        if match:
+            version = match.groupdict().get("version")
+            return service + " " + version.decode("ascii","replace").strip() if version else service
+    return "unknown" if data else ""
+
+# Method to turn a reply into one line of text for the output
+# Args: data - Bytes of the reply
+def printable(data):
+    return data[:BANNER_CHARS].decode("latin-1").encode("unicode_escape").decode("ascii")
+
+# Method to connect to a LISTENING port and identify the service on it
+# Returns [service, banner], both empty if nothing answered
+# Args: host - String of Hostname or IP
+#       port - Port of the service
+#       timeout - Number of seconds the grab may take
+def grabBanner(host,port,timeout):
+    address = scanResolver.getAddress(host)
+    if address == None:
+        return ["", ""]
+    deadline = time.monotonic() + timeout
+    data = b""
+    try:
+        sock = scanSocket.SOCKETS.open(scanAddress.family(address))
+    except OSError:
+        return ["", ""]
+    try:
+        sock.settimeout(timeout)
+        sock.connect((address,int(port)))
+        probe = PORT_PROBES.get(int(port))
+        if probe == None:
+            # Let services that talk first speak before sending anything
+            data = readBanner(sock,time.monotonic() + min(PASSIVE_WAIT, timeout / 2))
+            probe = HTTP_PROBE if not data else b""
+        if probe:
+            sock.sendall(probe)
+            data = readBanner(sock,deadline)
+    # Keep whatever was read before the service hung up
+    except OSError:
+        pass
+    finally:
+        scanSocket.SOCKETS.close(sock,True)
+    return [identify(data), printable(data)]
+
+
+# Class running banner grabs for LISTENING results in a pool of their own
+# The connect engines hand each result to onResult and go on, so slow
+# services only hold up this stage. Every result is passed on with
+# [service, banner] added, empty for ports that are not LISTENING. Only
+# QUEUE_DEPTH grabs per pool thread may wait, so memory stays flat. Once
+# they are all taken the engine handing in a LISTENING port waits for a free
+# slot, slowing the connects down to the pace of the grabs. A port is only
+# passed on as SKIPPED if no slot frees up within QUEUE_WAIT
+# Args: callback - Function called with (index, result) as each result completes
+#       poolsize - Max number of banner grabs in flight. Default POOLSIZE
+#       timeout - Number of seconds one banner grab may take. Default TIMEOUT
+class BannerStage:
+    def __init__(self,callback,poolsize=None,timeout=None):
+        self.callback = callback
+        self.timeout = timeout or TIMEOUT
+        poolsize = poolsize or POOLSIZE
+        self.pool = ThreadPool(poolsize)
+        # Grabs running or waiting in the pool
+        self.queue = threading.BoundedSemaphore(poolsize * QUEUE_DEPTH)
+        self.skipped = 0
+        # Results are passed on from the engine and the banner pool at once
+        self.lock = threading.Lock()
+        self.errors = []
+
+    # Method to take one result from the connect engine
+    # Args: index - Index of the test that produced the result
+    #       result - List of result values [request, host, port, result] + otherInfo
+    def onResult(self,index,result):
+        if result[3] != " LISTENING":
+            self.report(index,result + ["", ""])
+            return
+        if not self.queue.acquire(timeout=QUEUE_WAIT):
+            with self.lock:
+                self.skipped += 1
+            self.report(index,result + [SKIPPED, ""])
+            return
+        self.pool.apply_async(grabBanner, args=(result[1],result[2],self.timeout),
+                              callback=lambda banner, index=index, result=result: self.grabbed(index,result + banner),
+                              error_callback=self.failed)
+
+    # Method to pass on a result with its banner and free its queue slot
+    # Args: see report
+    def grabbed(self,index,result):
+        try:
+            self.report(index,result)
+        finally:
+            self.queue.release()
+
+    # Method to keep the first error raised by a grab and free its queue slot
+    # Args: err - Exception raised by grabBanner
+    def failed(self,err):
+        self.errors.append(err)
+        self.queue.release()
+
+    # Method to pass one result on
+    # Args: index - Index of the test that produced the result
+    #       result - List of result values with the service and banner
+    def report(self,index,result):
+        with self.lock:
+            self.callback(index,result)
+
+    # Method to wait for the banner grabs still running
+    # Args: complete - True if the scan finished. An interrupted scan drops them
+    def close(self,complete=True):
+        if complete:
+            self.pool.close()
+            self.pool.join()
+        else:
+            self.pool.terminate()
+        if self.skipped:
+            print("{} banner grabs skipped, the banner pool was stuck for {} Seconds".format(self.skipped, QUEUE_WAIT), file=sys.stderr)
+        if self.errors:
+            raise self.errors[0]
@@ -0,0 +1,213 @@
+# Author: Brenden Sweetman
+# Title: scanBench
+# Description: Reproducible benchmark of the connect engines against local loopback stand-in targets
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import portScanMT
+import scanEngine
+
+
+# Address the stand-in targets listen on
+BENCH_HOST = "127.0.0.1"
+# Number of ports of each kind of stand-in target
+TARGET_PORTS = 4
+# Max number of connections used to fill the backlog of a blackholed listener
+FILL_CONNECTIONS = 64
+
+
+# Class holding the loopback stand-in targets
+# Listening ports accept connects, closed ports answer with a RST, and
+# blackholed ports are listeners whose backlog is full, so SYNs are dropped
+# and connects time out
+class StandIns:
+    def __init__(self):
+        self.sockets = []
+        self.running = True
+        self.selector = selectors.DefaultSelector()
+        self.listening = [self.listener(128) for _ in range(TARGET_PORTS)]
+        # Accept and drop every connect on the listening ports
+        for sock in self.sockets:
+            self.selector.register(sock, selectors.EVENT_READ)
+        self.acceptor = threading.Thread(target=self.acceptAll,daemon=True)
+        self.acceptor.start()
+        self.closed = [self.closedPort() for _ in range(TARGET_PORTS)]
+        self.filtered = [self.blackhole() for _ in range(TARGET_PORTS)]
+
+    # Method run in a thread accepting connects on the listening ports
+    def acceptAll(self):
+        while self.running:
+            for key,_ in self.selector.select(0.2):
+                try:
+                    key.fileobj.accept()[0].close()
+                except OSError:
+                    pass
+
+    # Method to open a listening socket and return its port
+    # Args: backlog - Backlog of the listener
+    def listener(self,backlog):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((BENCH_HOST,0))
+        sock.listen(backlog)
+        self.sockets.append(sock)
+        return sock.getsockname()[1]
+
+    # Method to find a port nothing listens on
+    def closedPort(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((BENCH_HOST,0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    # Method to open a listener that never accepts and fill its backlog
+    def blackhole(self):
+        port = self.listener(0)
+        for _ in range(FILL_CONNECTIONS):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(0.2)
+            try:
+                sock.connect((BENCH_HOST,port))
+                self.sockets.append(sock)
+            except socket.timeout:
+                # Backlog is full, further SYNs are dropped
+                sock.close()
+                return port
+        raise RuntimeError("Could not fill the backlog of port {}".format(port))
+
+    # Method to close every stand-in socket
+    def close(self):
+        self.running = False
+        self.acceptor.join()
+        self.selector.close()
+        for sock in self.sockets:
+            sock.close()
+
+# Method to build the list of tests, spreading probes over the stand-ins
+# Args: standIns - StandIns to probe
+#       probes - Total number of probes
+#       filtered - Fraction of probes sent to blackholed ports
+def getBenchList(standIns,probes,filtered):
+    filteredCount = int(probes * filtered)
+    answered = standIns.listening + standIns.closed
+    tests = [[BENCH_HOST,BENCH_HOST,str(answered[i % len(answered)])] for i in range(probes - filteredCount)]
+    tests += [[BENCH_HOST,BENCH_HOST,str(standIns.filtered[i % len(standIns.filtered)])] for i in range(filteredCount)]
+    return tests
+
+# Method to run one benchmark configuration, in a fresh process so peak RSS and CPU are its own
+# Args: engine - Connect engine, "thread" or "async"
+#       poolsize - Size of the pool
+#       tests - List of [request, host, port] tests
+#       timeout - Number of seconds to wait with no reply
+#       resultQueue - multiprocessing Queue the measurements are put on
+def benchRun(engine,poolsize,tests,timeout,resultQueue):
+    latencies = []
+    counts = {}
+
+    # Record one finished probe
+    def finished(index,result):
+        counts[str(result[3])] = counts.get(str(result[3]),0) + 1
+
+    # Time a threaded probe
+    def timedTestPort(request,host,port,timeout):
+        start = time.perf_counter()
+        result = portScanMT.testPort(request,host,port,timeout)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    # Time an async probe
+    async def asyncTimedTestPort(request,host,port,otherInfo,timeout):
+        start = time.perf_counter()
+        result = await scanEngine.asyncTestPort(request,host,port,otherInfo,timeout)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    startUsage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    if engine == "async":
+        scanEngine.runAsync(enumerate(tests),timeout,poolsize,finished,asyncTimedTestPort)
+    else:
+        scanEngine.runThreaded(timedTestPort,((index,tuple(test + [timeout])) for index,test in enumerate(tests)),poolsize,finished)
+    seconds = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    latencies.sort()
+    resultQueue.put({
+        "engine": engine,
+        "poolsize": poolsize,
+        "probes": len(tests),
+        "seconds": round(seconds,4),
+        "probesPerSec": round(len(tests) / seconds,1),
+        "p50Latency": round(percentile(latencies,50),6),
+        "p99Latency": round(percentile(latencies,99),6),
+        # ru_maxrss is KB on Linux and bytes on macOS
+        "peakRssKb": usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss,
+        "cpuSeconds": round(usage.ru_utime + usage.ru_stime - startUsage.ru_utime - startUsage.ru_stime,4),
+        "results": counts,
+    })
+
+# Method to get a percentile of a sorted list
+# Args: values - Sorted list of numbers
+#       pct - Percentile from 0 to 100
+def percentile(values,pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+# Method to describe the code and machine being benchmarked
+def getMeta():
+    try:
+        commit = subprocess.run(["git","rev-parse","--short","HEAD"],capture_output=True,text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+# Script Start Piont:
+if __name__ == "__main__":
+    # Parse CMD line args
+    parser = argparse.ArgumentParser(description='Benchmark the port scanner engines against loopback stand-in targets')
+    parser.add_argument("-o","--output",help='Output File (JSON). Default benchResults.json',default="benchResults.json")
+    parser.add_argument("-e","--engines",help='Engines to benchmark. Default thread async',nargs="+",choices=["thread","async"],default=["thread","async"])
+    parser.add_argument("-p","--poolsizes",help='Pool sizes to benchmark. Default 1 5 20 100',nargs="+",type=int,default=[1,5,20,100])
+    parser.add_argument("-n","--probes",help='Number of probes per run. Default 2000',type=int,default=2000)
+    parser.add_argument("-f","--filtered",help='Fraction of probes sent to blackholed ports. Default 0.01',type=float,default=0.01)
+    parser.add_argument("-t","--timeout",help='Timeout to wait for reply (Seconds). Default 1 Second',type=float,default=1)
+    args = parser.parse_args()
+
+    standIns = StandIns()
+    tests = getBenchList(standIns,args.probes,args.filtered)
+    runs = []
+    context = multiprocessing.get_context("spawn")
+    try:
+        for engine in args.engines:
+            for poolsize in args.poolsizes:
+                resultQueue = context.Queue()
+                process = context.Process(target=benchRun,args=(engine,poolsize,tests,args.timeout,resultQueue))
+                process.start()
+                run = resultQueue.get()
+                process.join()
+                runs.append(run)
+                print("{engine:>6} pool {poolsize:>5}: {probesPerSec:>9} probes/sec  p50 {p50Latency:.4f}s  p99 {p99Latency:.4f}s  rss {peakRssKb} KB  cpu {cpuSeconds}s".format(**run))
+    finally:
+        standIns.close()
+    # Write machine readable results
+    with open(args.output,"w") as outFile:
+        json.dump({"meta": getMeta(), "runs": runs}, outFile, indent=2)
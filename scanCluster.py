@@ -0,0 +1,373 @@
+# Author: Brenden Sweetman
+# Title: scanCluster
+# Description: Coordinator handing a scan out in leased chunks to worker nodes over TCP, and the worker that scans them
+
+
+import argparse
+import base64
+import bisect
+import hmac
+import json
+import multiprocessing
+import os
+import random
+import secrets
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+
+import scanInput
+import scanMain
+import scanMetrics
+import scanSchedule
+import scanSocket
+
+
+# Default number of tests in one leased chunk
+CHUNK_TESTS = 16384
+# Default seconds a worker holds a chunk without renewing its lease
+LEASE_SECONDS = 60
+# Seconds a worker waits when every chunk left is leased to another worker
+LEASE_WAIT = 1
+# Scripts a coordinator may ask workers to run
+SCRIPTS = ("portScanMT", "portScanMTcsv")
+# Scan options each worker always sets for itself, defaults included
+LOCAL_OPTIONS = ("poolsize", "engine", "auto", "fast_close", "source", "source_ports")
+# Scan options the coordinator sends to workers. File paths and options only
+# meaning something on the coordinator stay there
+JOB_OPTIONS = ("timeout", "adaptive", "min_timeout", "dns_ttl", "ipv6", "dedup", "randomize", "seed",
+               "retries", "first_timeout", "rate", "host_rate", "subnet_rate",
+               "banners", "banner_poolsize", "banner_timeout")
+# Environment variable holding the shared token, which keeps it out of the process list
+TOKEN_ENV = "SCAN_CLUSTER_TOKEN"
+
+
+# Method to parse a --chunk-size, which must hold at least one test
+# Args: text - String of the number of tests
+def chunkSize(text):
+    try:
+        size = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("chunk size must be a number: " + text)
+    if size < 1:
+        raise argparse.ArgumentTypeError("chunk size must be at least 1: " + text)
+    return size
+
+# Method to split a HOST:PORT address, HOST defaults to localhost
+# Args: address - String of HOST:PORT
+def parseAddress(address):
+    host,_,port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+# Method to send one message as a line of JSON
+# Args: stream - Writable binary file of the connection
+#       message - Dict of the message
+def sendMessage(stream,message):
+    stream.write(json.dumps(message).encode() + b"\n")
+    stream.flush()
+
+# Method to read one message, or None once the connection is closed
+# Args: stream - Readable binary file of the connection
+def readMessage(stream):
+    line = stream.readline()
+    return json.loads(line) if line else None
+
+# Method to make a result sendable as JSON
+# Errors are sent as their text, which is what the csv shows for them
+# Args: result - List of result values [request, host, port, result] + otherInfo
+def toJson(result):
+    return [value if value == None or isinstance(value,(str,int,float)) else str(value) for value in result]
+
+
+# Class of the chunks of a scan and the worker leasing each one
+# A lease not renewed in time, or held by a worker that disconnects, goes
+# back to the pending chunks. Only the worker holding a chunk's lease may
+# complete it, and any other copy is dropped, so every result is merged once
+# Args: count - Number of chunks
+#       leaseSeconds - Seconds a lease lasts without renewal
+#       callback - Function called with (index, result) for every merged result
+#       order - Optional list of chunk ids in the order they are handed out
+class LeaseTable:
+    def __init__(self,count,leaseSeconds,callback,order=None):
+        self.leaseSeconds = leaseSeconds
+        self.callback = callback
+        self.pending = deque(order if order != None else range(count))
+        # Chunk id -> [owner, deadline]
+        self.leases = {}
+        self.done = bytearray(count)
+        self.remaining = count
+        self.lock = threading.Lock()
+        # Results of one chunk are merged at a time
+        self.mergeLock = threading.Lock()
+        self.finished = threading.Event()
+        if count == 0:
+            self.finished.set()
+
+    # Method to lease the next chunk to a worker
+    # Returns the chunk id, or None if no chunk is pending
+    # Args: owner - Connection of the worker
+    def lease(self,owner):
+        with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+            if not self.pending:
+                return None
+            chunk = self.pending.popleft()
+            self.leases[chunk] = [owner, now + self.leaseSeconds]
+            return chunk
+
+    # Method to put expired leases back in the pending chunks, lock must be held
+    # Args: now - Current time.monotonic()
+    def expire(self,now):
+        for chunk,(owner,deadline) in list(self.leases.items()):
+            if deadline < now:
+                del self.leases[chunk]
+                self.pending.append(chunk)
+                print("Lease of chunk {} expired, handing it out again".format(chunk), file=sys.stderr)
+
+    # Method to extend a worker's lease on a chunk
+    # Args: chunk - Chunk id
+    #       owner - Connection of the worker
+    def renew(self,chunk,owner):
+        with self.lock:
+            lease = self.leases.get(chunk)
+            if lease != None and lease[0] is owner:
+                lease[1] = time.monotonic() + self.leaseSeconds
+
+    # Method to put every chunk leased to a worker back in the pending chunks
+    # Args: owner - Connection of the worker
+    def release(self,owner):
+        with self.lock:
+            for chunk,lease in list(self.leases.items()):
+                if lease[0] is owner:
+                    del self.leases[chunk]
+                    self.pending.appendleft(chunk)
+
+    # Method to merge the results of a chunk sent by the worker holding its lease
+    # Results of a chunk not leased to the worker are dropped
+    # Args: chunk - Chunk id
+    #       results - List of (index, result) pairs
+    #       owner - Connection of the worker
+    def complete(self,chunk,results,owner):
+        with self.lock:
+            lease = self.leases.get(chunk)
+            if lease == None or lease[0] is not owner:
+                return
+            self.done[chunk] = 1
+            del self.leases[chunk]
+        with self.mergeLock:
+            for index,result in results:
+                self.callback(index,result)
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.finished.set()
+
+
+# Class handling one worker connection on the coordinator
+# A worker must open with the shared token before it is sent the job
+class WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        table = self.server.table
+        try:
+            hello = readMessage(self.rfile)
+        except (OSError, ValueError):
+            return
+        if not isinstance(hello,dict) or not hmac.compare_digest(str(hello.get("token")).encode(),self.server.token.encode()):
+            print("Refused a worker from {} without the cluster token".format(self.client_address[0]), file=sys.stderr)
+            return
+        sendMessage(self.wfile,self.server.job)
+        try:
+            while True:
+                message = readMessage(self.rfile)
+                if message == None:
+                    break
+                if message["type"] == "lease":
+                    chunk = table.lease(self)
+                    if chunk != None:
+                        sendMessage(self.wfile,self.server.chunkMessage(chunk))
+                    elif table.finished.is_set():
+                        sendMessage(self.wfile,{"type": "done"})
+                    else:
+                        sendMessage(self.wfile,{"type": "wait", "seconds": LEASE_WAIT})
+                elif message["type"] == "renew":
+                    table.renew(message["chunk"],self)
+                elif message["type"] == "results":
+                    table.complete(message["chunk"],message["results"],self)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        finally:
+            # Hand the chunks of a lost worker out again at once
+            table.release(self)
+
+# Class of the coordinator's TCP server
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+# Method to hand a scan out to workers and merge their results
+# The tests are split into chunks of consecutive indices. Each chunk is sent
+# with only the input lines it covers, so workers expand their own targets.
+# Hitlists are sent as the packed addresses the chunk covers, workers never
+# read the hitlist files
+# Args: address - String of HOST:PORT to listen on
+#       script - Name of the script workers pass to scanMain.runScan
+#       inList - list of split lines from input csv
+#       intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+#       args - Parsed command line arguments sent to every worker
+#       callback - Function called with (index, result) for every merged result
+#       token - Shared token workers must send. Default TOKEN_ENV, or a new one that is printed
+def runCoordinator(address,script,inList,intervals,args,callback,token=None):
+    token = token or os.environ.get(TOKEN_ENV)
+    if not token:
+        token = secrets.token_hex(16)
+        print("Cluster token {}, start workers with {}={}".format(token, TOKEN_ENV, token), file=sys.stderr)
+    offsets,total = scanSchedule.getOffsets(intervals)
+    chunkSize = args.chunk_size
+    count = (total + chunkSize - 1) // chunkSize
+    # Hand chunks out in a random order too when interleaving hosts
+    order = list(range(count)) if args.randomize else None
+    if order != None:
+        random.Random(args.seed).shuffle(order)
+    table = LeaseTable(count,args.lease,callback,order)
+
+    # Build the lease message of one chunk
+    def chunkMessage(chunk):
+        start = chunk * chunkSize
+        end = min(start + chunkSize, total)
+        first = bisect.bisect_right(offsets,start) - 1
+        last = bisect.bisect_left(offsets,end)
+        lines = [[inValue[0], inValue[1].ranges()] + list(inValue[2:]) for inValue in inList[first:last]]
+        base = offsets[first]
+        hitlists = {}
+        names = [line[0] for line in lines]
+        for lineId in range(first,last):
+            host = inList[lineId][0]
+            if not scanInput.isHitlist(host):
+                continue
+            hitlist = scanInput.getHitlist(host)
+            skip,stop = 0,len(hitlist)
+            # A hitlist named by one line of the chunk is cut to the addresses
+            # the chunk covers, one named twice is sent whole
+            if names.count(host) == 1:
+                ports = len(inList[lineId][1])
+                skip = max(start - offsets[lineId], 0) // ports
+                stop = min(stop, (end - offsets[lineId] + ports - 1) // ports)
+            # Only the first line can start before the chunk
+            if lineId == first:
+                base += skip * len(inList[lineId][1])
+            hitlists[host] = base64.b64encode(hitlist.packed[skip * 16:stop * 16]).decode("ascii")
+        return {"type": "chunk", "chunk": chunk, "start": start, "end": end, "base": base, "lines": lines, "hitlists": hitlists}
+
+    server = CoordinatorServer(parseAddress(address),WorkerHandler)
+    server.table = table
+    server.token = token
+    server.chunkMessage = chunkMessage
+    server.job = {"type": "job", "script": script, "args": {name: getattr(args,name) for name in JOB_OPTIONS}, "lease": args.lease}
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    print("Coordinator listening on {}:{}, {} chunks of {} tests".format(*server.server_address, count, chunkSize), file=sys.stderr)
+    try:
+        # Wait in steps so an interrupt is seen
+        while not table.finished.wait(1):
+            pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# Method to scan chunks leased from a coordinator until the scan is done
+# Args: address - String of HOST:PORT of the coordinator
+#       local - Dict of scan options set on this worker
+#       token - Shared token of the coordinator
+def runWorker(address,local,token):
+    with socket.create_connection(parseAddress(address)) as sock:
+        stream = sock.makefile("rwb")
+        sendMessage(stream,{"type": "hello", "token": token})
+        job = readMessage(stream)
+        if job == None:
+            raise RuntimeError("Coordinator refused this worker, check the cluster token")
+        if job["script"] not in SCRIPTS:
+            raise RuntimeError("Coordinator sent no job this worker can run")
+        args = argparse.Namespace(**job["args"])
+        # Node local options are always the worker's own, defaults included
+        for name,value in local.items():
+            setattr(args,name,value)
+        args.workers = 1
+        scanMain.configure(args)
+        # Renewals are sent while the scan runs
+        lock = threading.Lock()
+        while True:
+            with lock:
+                sendMessage(stream,{"type": "lease"})
+            message = readMessage(stream)
+            if message == None or message["type"] == "done":
+                break
+            if message["type"] == "wait":
+                time.sleep(message["seconds"])
+                continue
+            chunk = message["chunk"]
+            base = message["base"]
+            inList = [[line[0], scanInput.PortList(line[1])] + line[2:] for line in message["lines"]]
+            for host,packed in message["hitlists"].items():
+                scanInput.HITLISTS[host[len(scanInput.HITLIST_MARK):]] = scanInput.Hitlist(base64.b64decode(packed))
+            results = []
+            scanMetrics.METRICS.reset(message["end"] - message["start"])
+            stopped = threading.Event()
+
+            # Renew the lease until the chunk is scanned
+            def renew():
+                while not stopped.wait(job["lease"] / 3):
+                    with lock:
+                        sendMessage(stream,{"type": "renew", "chunk": chunk})
+
+            renewer = threading.Thread(target=renew,daemon=True)
+            renewer.start()
+            try:
+                scanMain.runScan(job["script"],inList,None,args,None,None,None,(message["start"] - base, message["end"] - base),
+                                 lambda index,result: results.append([index + base, toJson(result)]))
+            finally:
+                stopped.set()
+                renewer.join()
+            with lock:
+                sendMessage(stream,{"type": "results", "chunk": chunk, "results": results})
+            print("Chunk {} done, {} results".format(chunk, len(results)), file=sys.stderr)
+
+# Method run in each worker process
+# Args: see runWorker
+def workerProcess(address,local,token):
+    try:
+        runWorker(address,local,token)
+    except KeyboardInterrupt:
+        pass
+
+
+# Script Start Piont:
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scan worker taking leased chunks of a scan from a portScanMT --coordinator')
+    parser.add_argument("coordinator",help='HOST:PORT of the coordinator')
+    parser.add_argument("-p","--poolsize",help='Size of muti-threaded pool. Default 5 threads (1000 for the async engine)',type=int)
+    parser.add_argument("-e","--engine",help='Connect engine, thread pool or asyncio event loop. Default thread',choices=["thread","async"],default="thread")
+    parser.add_argument("--auto",help='Tune the number of connects in flight, starting from --poolsize',action="store_true")
+    parser.add_argument("--fast-close",help='Abort accepted connects with a RST (SO_LINGER 0) so they leave no TIME_WAIT entry',action="store_true")
+    parser.add_argument("--source",help='Comma separated local addresses to send probes from, in turn')
+    parser.add_argument("--source-ports",help='Range of local ports to send probes from, in turn (LOW-HIGH)',type=scanSocket.portRange)
+    parser.add_argument("-w","--workers",help='Number of worker processes on this node, each leasing its own chunks. Default 1',type=int,default=1)
+    parser.add_argument("--token",help='Shared token printed by the coordinator. Default from the ' + TOKEN_ENV + ' environment variable',default=os.environ.get(TOKEN_ENV))
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("a cluster token is needed, pass --token or set " + TOKEN_ENV)
+    local = {name: getattr(args,name) for name in LOCAL_OPTIONS}
+    startTime = time.time()
+    if args.workers > 1:
+        processes = [multiprocessing.Process(target=workerProcess,args=(args.coordinator,local,args.token)) for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        workerProcess(args.coordinator,local,args.token)
+    print("Execution Time {:.2f} Seconds".format(time.time() - startTime))
@@ -0,0 +1,457 @@
+# Author: Brenden Sweetman
+# Title: scanDaemon
+# Description: Long running scan daemon taking jobs over a localhost HTTP or Unix socket API
+
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import portScanMT
+import scanEngine
+import scanInput
+import scanMetrics
+import scanOutput
+import scanResolver
+import scanSocket
+import scanTiming
+import scanTune
+
+
+# Seconds the dispatcher waits when no job has tests left to start
+IDLE_WAIT = 0.02
+# Number of finished jobs kept for status and result requests
+KEEP_JOBS = 1000
+# Number of result rows kept in memory over all jobs without an output file
+KEEP_ROWS = 1000000
+# Hosts a request may name in its Host header, anything else may be a DNS
+# rebinding page reaching the API through a hostname it controls
+ALLOWED_HOSTS = ("localhost", "127.0.0.1")
+# Default timeout of a job (Seconds)
+JOB_TIMEOUT = 10
+
+
+# Class of one scan job
+# Results are kept in memory for streaming, or written to a csv if the job has an output sink
+# Args: jobId - Int id of the job
+#       inList - list of split lines in the portScanMT input format
+#       timeout - Number of seconds to wait with no reply
+#       outFile - Optional file name of a csv to write results to instead
+#       weight - Number of tests started for this job on each round robin turn
+#       onDone - Optional function called with the job once it has finished
+class Job:
+    def __init__(self,jobId,inList,timeout,outFile=None,weight=1,onDone=None):
+        self.id = jobId
+        self.timeout = timeout
+        self.weight = weight
+        self.planned = portScanMT.countDestList(inList)
+        self.tests = enumerate(portScanMT.getDestList(inList))
+        self.output = scanOutput.CsvStream(outFile,portScanMT.CSV_HEADER) if outFile != None else None
+        self.outFile = outFile
+        self.results = [] if outFile == None else None
+        self.state = "queued"
+        self.started = 0
+        self.completed = 0
+        self.exhausted = False
+        self.onDone = onDone
+        self.condition = threading.Condition()
+
+    # Method to get the status of the job
+    def status(self):
+        with self.condition:
+            return {"id": self.id, "state": self.state, "planned": self.planned,
+                    "started": self.started, "completed": self.completed, "output": self.outFile}
+
+    # Method to get the next test of the job, or None once every test has started
+    def nextTest(self):
+        test = next(self.tests,None)
+        with self.condition:
+            if test == None:
+                self.exhausted = True
+                self.finishIfDone()
+            else:
+                self.started += 1
+                self.state = "running"
+        return test
+
+    # Method to keep or write one result
+    # Args: index - Index of the test in the job
+    #       result - List of result values [request, host, port, result]
+    def record(self,index,result):
+        scanMetrics.METRICS.record(result)
+        with self.condition:
+            if self.state == "cancelled":
+                return
+            self.completed += 1
+            if self.output != None:
+                self.output.write(index,result)
+            else:
+                self.results.append(result)
+            self.finishIfDone()
+            self.condition.notify_all()
+
+    # Method to mark the job finished once every test has started and completed
+    # The caller holds the condition
+    def finishIfDone(self):
+        if self.exhausted and self.completed == self.started and self.state in ("queued", "running"):
+            self.state = "done"
+            self.close()
+            self.condition.notify_all()
+            if self.onDone != None:
+                self.onDone(self)
+
+    # Method to stop the job, dropping results of tests still in flight
+    def cancel(self):
+        with self.condition:
+            if self.state in ("queued", "running"):
+                self.state = "cancelled"
+                self.close()
+                self.condition.notify_all()
+
+    # Method to close the output sink
+    def close(self):
+        if self.output != None:
+            self.output.close()
+
+    # Generator of the job's results, following the job until it ends
+    def follow(self):
+        position = 0
+        while True:
+            with self.condition:
+                while position == len(self.results) and self.state in ("queued", "running"):
+                    self.condition.wait()
+                results = self.results[position:]
+                position += len(results)
+                finished = self.state not in ("queued", "running")
+            if results:
+                yield results
+            if finished and position == len(self.results):
+                return
+
+
+# Class keeping the jobs and feeding their tests to one warm engine
+# Active jobs take turns starting tests, each taking its weight in tests per
+# turn, so a huge sweep can not hold back a small check queued behind it
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self.active = deque()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    # Method to add a job
+    # Args: see Job
+    def submit(self,inList,timeout,outFile=None,weight=1):
+        job = Job(next(self.ids),inList,timeout,outFile,weight,self.forget)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.active.append(job)
+        self.forget()
+        return job
+
+    # Method to forget the oldest finished jobs past KEEP_JOBS, or while the
+    # rows kept in memory are past KEEP_ROWS. A client still streaming a
+    # forgotten job's results keeps reading them
+    # Args: job - Job that just finished, unused
+    def forget(self,job=None):
+        with self.lock:
+            finished = [old for old in self.jobs.values() if old.state not in ("queued", "running")]
+            rows = sum(len(old.results) for old in self.jobs.values() if old.results != None)
+            for old in finished:
+                if len(finished) <= KEEP_JOBS and rows <= KEEP_ROWS:
+                    break
+                del self.jobs[old.id]
+                finished = finished[1:]
+                rows -= len(old.results) if old.results != None else 0
+
+    # Method to get a job by id, or None
+    # Args: jobId - Int id of the job
+    def get(self,jobId):
+        with self.lock:
+            return self.jobs.get(jobId)
+
+    # Method to get the next job to start a test for, round robin
+    def nextJob(self):
+        with self.lock:
+            while self.active:
+                job = self.active[0]
+                self.active.rotate(-1)
+                if job.exhausted or job.state == "cancelled":
+                    self.active.remove(job)
+                    continue
+                return job
+        return None
+
+    # Generator of ((job, index), test) pairs for the engine, or (None, seconds) pauses while idle
+    def tests(self):
+        while True:
+            job = self.nextJob()
+            if job == None:
+                yield None, IDLE_WAIT
+                continue
+            for _ in range(job.weight):
+                test = job.nextTest()
+                if test == None:
+                    break
+                index,test = test
+                # The job timeout rides along as the test's other info
+                yield (job,index), test + [job.timeout]
+
+    # Method to hand a result to its job
+    # Args: index - (job, index) pair
+    #       result - List of result values [request, host, port, result]
+    def record(self,index,result):
+        job,index = index
+        job.record(index,result)
+
+# Coroutine testing a port with the timeout of its job
+# Args: see scanEngine.asyncTestPort, otherInfo holds the job timeout
+async def jobTestPort(request,host,port,otherInfo,timeout):
+    return await scanEngine.asyncTestPort(request,host,port,[],otherInfo[0])
+
+# Method to get where a job may write its output
+# Outputs are confined to one directory, so a job can not overwrite any other file
+# Args: outputDir - Directory job outputs are written to, or None if jobs may not write files
+#       name - File name asked for by the job
+def outputPath(outputDir,name):
+    if outputDir == None:
+        raise ValueError("output files are disabled, start the daemon with --output-dir")
+    if not isinstance(name,str) or not name or os.path.isabs(name) or ".." in name.replace("\\","/").split("/"):
+        raise ValueError("output must be a relative file name without ..")
+    path = os.path.realpath(os.path.join(outputDir,name))
+    # A symbolic link inside the directory may still point out of it
+    if os.path.commonpath([path, os.path.realpath(outputDir)]) != os.path.realpath(outputDir):
+        raise ValueError("output must stay inside the output directory")
+    return path
+
+# Method to parse the target lines of a job in the portScanMT input format
+# Returns the split lines and a list of error messages
+# Args: targets - List of "host ports" strings
+def parseTargets(targets):
+    errors = []
+
+    # Keep the error of a bad line
+    def badLine(count,line,reason):
+        errors.append("ERROR at line " + str(count) + ":[" + line + "]: " + reason)
+    inList = list(scanInput.parseTargets((str(line).strip() for line in targets),badLine))
+    return inList,errors
+
+
+# Class serving the job API
+# POST /jobs              {"targets": ["host ports", ...], "timeout": 10, "output": "file.csv", "weight": 1}
+#                         sent as application/json, output is a file in the --output-dir
+# GET /jobs               Status of every job
+# GET /jobs/ID            Status of one job
+# GET /jobs/ID/results    Results of a job as csv, streamed until the job ends
+# DELETE /jobs/ID         Cancel a job
+# GET /metrics            Scan metrics in the Prometheus text format
+class JobHandler(BaseHTTPRequestHandler):
+    scheduler = None
+    outputDir = None
+
+    # Method to send a JSON body
+    # Args: code - HTTP status code
+    #       body - Object to send
+    def sendJson(self,code,body):
+        data = (json.dumps(body) + "\n").encode()
+        self.send_response(code)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Method to get the job named in the path, sending a 404 if there is none
+    def getJob(self):
+        parts = self.path.strip("/").split("/")
+        job = None
+        if len(parts) >= 2 and parts[0] == "jobs" and parts[1].isdigit():
+            job = self.scheduler.get(int(parts[1]))
+        if job == None:
+            self.sendJson(404,{"error": "no such job"})
+        return job
+
+    # Method to check the Host header names this machine, sending a 403 if it does not
+    # A DNS rebinding page reaches the API under its own hostname, which this rejects
+    def checkHost(self):
+        host = self.headers.get("Host","")
+        if host.startswith("["):
+            host = host[:host.find("]") + 1]
+        else:
+            host = host.partition(":")[0]
+        if host.lower() in ALLOWED_HOSTS:
+            return True
+        self.sendJson(403,{"error": "bad Host header"})
+        return False
+
+    def do_POST(self):
+        if not self.checkHost():
+            return
+        if self.path.rstrip("/") != "/jobs":
+            self.sendJson(404,{"error": "not found"})
+            return
+        # A browser can only send a JSON body to another site after asking
+        # first, so any other type may be a web page posting to localhost
+        if self.headers.get_content_type() != "application/json":
+            self.sendJson(415,{"error": "jobs must be sent as application/json"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length",0))) or b"{}")
+            if not isinstance(body["targets"],list):
+                raise TypeError("targets must be a list of lines")
+            inList,errors = parseTargets(body["targets"])
+            timeout = float(body["timeout"]) if body.get("timeout") != None else JOB_TIMEOUT
+            if not timeout > 0:
+                raise ValueError("timeout must be above 0")
+            weight = max(int(body.get("weight",1)), 1)
+            outFile = outputPath(self.outputDir,body["output"]) if body.get("output") != None else None
+        except (ValueError, KeyError, TypeError) as err:
+            self.sendJson(400,{"error": "bad job: {}".format(err)})
+            return
+        if errors:
+            self.sendJson(400,{"error": "bad targets", "lines": errors})
+            return
+        # Results of a job without an output file are kept in memory
+        if outFile == None and portScanMT.countDestList(inList) > KEEP_ROWS:
+            self.sendJson(400,{"error": "job has more than {} tests, give it an output file".format(KEEP_ROWS)})
+            return
+        # Resolve each unique hostname once, ahead of the job's connects
+        scanResolver.resolveAll(inValue[0] for inValue in inList if not (scanInput.isHitlist(inValue[0]) or scanInput.RANGE.search(inValue[0]) or scanInput.SUBNET.search(inValue[0])))
+        try:
+            job = self.scheduler.submit(inList,timeout,outFile,weight)
+        except OSError as err:
+            self.sendJson(400,{"error": "bad output: {}".format(err)})
+            return
+        self.sendJson(201,job.status())
+
+    def do_GET(self):
+        if not self.checkHost():
+            return
+        if self.path == "/metrics":
+            data = scanMetrics.prometheusText(scanMetrics.METRICS.snapshot()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type","text/plain; version=0.0.4")
+            self.send_header("Content-Length",str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if self.path.rstrip("/") == "/jobs":
+            with self.scheduler.lock:
+                jobs = list(self.scheduler.jobs.values())
+            self.sendJson(200,[job.status() for job in jobs])
+            return
+        job = self.getJob()
+        if job == None:
+            return
+        if not self.path.rstrip("/").endswith("/results"):
+            self.sendJson(200,job.status())
+            return
+        if job.results == None:
+            self.sendJson(409,{"error": "results are written to " + job.outFile})
+            return
+        # Stream rows as they complete, the body ends when the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type","text/csv")
+        self.end_headers()
+        self.wfile.write(portScanMT.CSV_HEADER.encode())
+        for results in job.follow():
+            rows = io.StringIO()
+            csv.writer(rows,lineterminator="\n").writerows(results)
+            self.wfile.write(rows.getvalue().encode())
+            self.wfile.flush()
+
+    def do_DELETE(self):
+        if not self.checkHost():
+            return
+        job = self.getJob()
+        if job != None:
+            job.cancel()
+            self.sendJson(200,job.status())
+
+    # Keep requests out of the daemon output
+    def log_message(self,*args):
+        pass
+
+
+# Class of a threading HTTP server on a Unix socket
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Class of the job handler on a Unix socket, which has no client address
+# A browser can not reach a Unix socket, so any Host header is accepted
+class UnixJobHandler(JobHandler):
+    def address_string(self):
+        return "unix"
+
+    def checkHost(self):
+        return True
+
+
+# Script Start Piont:
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scan daemon keeping warm executors, DNS cache and RTT state between jobs')
+    parser.add_argument("--port",help='Serve the job API on localhost:PORT. Default 8765',type=int)
+    parser.add_argument("--socket",help='Serve the job API on this Unix socket instead')
+    parser.add_argument("--output-dir",help='Directory jobs may write output csv files to. Default jobs may not write files')
+    parser.add_argument("-p","--poolsize",help='Max connects in flight over all jobs. Default 5 threads (1000 for the async engine)',type=int)
+    parser.add_argument("-e","--engine",help='Connect engine, thread pool or asyncio event loop. Default async',choices=["thread","async"],default="async")
+    parser.add_argument("--dns-ttl",help='Seconds to cache resolved hostnames. Default 300 Seconds',type=int)
+    parser.add_argument("-6","--ipv6",help='Resolve hostnames to IPv6 addresses too, not only IPv4',action="store_true")
+    parser.add_argument("-a","--adaptive",help='Adapt each timeout to the measured round trip time of the target subnet, capped at the job timeout',action="store_true")
+    parser.add_argument("--min-timeout",help='Shortest adaptive timeout (Seconds). Default 0.05 Seconds',type=float)
+    parser.add_argument("--auto",help='Tune the number of connects in flight, starting from --poolsize',action="store_true")
+    parser.add_argument("--fast-close",help='Abort accepted connects with a RST (SO_LINGER 0) so they leave no TIME_WAIT entry',action="store_true")
+    args = parser.parse_args()
+
+    # State kept warm between jobs
+    scanTiming.RTT.enabled = args.adaptive
+    if args.min_timeout != None:
+        scanTiming.RTT.minTimeout = args.min_timeout
+    if args.dns_ttl != None:
+        scanResolver.CACHE.ttl = args.dns_ttl
+    if args.ipv6:
+        scanResolver.CACHE.family = socket.AF_UNSPEC
+    scanTune.TUNER.enabled = args.auto
+    scanSocket.SOCKETS.fastClose = args.fast_close
+
+    scheduler = Scheduler()
+    JobHandler.scheduler = scheduler
+    JobHandler.outputDir = args.output_dir
+    if args.socket != None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        # Only this user may connect, the socket is created 0600
+        umask = os.umask(0o177)
+        try:
+            server = ThreadingUnixHTTPServer(args.socket,UnixJobHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(args.socket,0o600)
+        where = args.socket
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1",args.port or 8765),JobHandler)
+        where = "http://127.0.0.1:{}".format(server.server_address[1])
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    print("Scan daemon listening on " + where, file=sys.stderr)
+    try:
+        # One engine runs for the life of the daemon, fed by the scheduler
+        if args.engine == "async":
+            scanEngine.runAsync(scheduler.tests(),None,args.poolsize,scheduler.record,jobTestPort)
+        else:
+            scanEngine.runThreaded(portScanMT.testPort,((index,tuple(test) if index != None else test) for index,test in scheduler.tests()),args.poolsize,scheduler.record)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if args.socket != None and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,172 @@
+# Author: Brenden Sweetman
+# Title: scanDatabase
+# Description: SQLite result sink keeping every scan's results and the last seen state of each (host, port)
+
+
+import json
+import sqlite3
+import threading
+import time
+
+import scanAddress
+import scanEngine
+import scanStore
+
+
+# Number of results written per transaction
+BATCH_ROWS = 5000
+# Max seconds a result waits before it is written
+FLUSH_SECONDS = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    input TEXT,
+    output TEXT,
+    started REAL,
+    finished REAL,
+    complete INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS results (
+    scan INTEGER NOT NULL,
+    request TEXT,
+    host TEXT NOT NULL,
+    ip INTEGER,
+    port INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    error TEXT,
+    info TEXT,
+    seen REAL
+);
+CREATE INDEX IF NOT EXISTS resultsIp ON results (ip, port);
+CREATE INDEX IF NOT EXISTS resultsPort ON results (port, status);
+CREATE INDEX IF NOT EXISTS resultsScan ON results (scan, status);
+CREATE TABLE IF NOT EXISTS state (
+    host TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    ip INTEGER,
+    request TEXT,
+    status INTEGER NOT NULL,
+    error TEXT,
+    info TEXT,
+    firstSeen REAL,
+    lastSeen REAL,
+    changed REAL,
+    scan INTEGER,
+    PRIMARY KEY (host, port)
+);
+CREATE INDEX IF NOT EXISTS stateIp ON state (ip);
+CREATE INDEX IF NOT EXISTS statePort ON state (port, status, ip);
+CREATE INDEX IF NOT EXISTS stateScan ON state (scan);
+"""
+
+INSERT_RESULT = "INSERT INTO results VALUES (?,?,?,?,?,?,?,?,?)"
+
+# Keep the first time a (host, port) was seen, and when its status last changed
+UPSERT_STATE = """
+INSERT INTO state (host, port, ip, request, status, error, info, firstSeen, lastSeen, changed, scan)
+VALUES (?,?,?,?,?,?,?,?,?,?,?)
+ON CONFLICT (host, port) DO UPDATE SET
+    ip = excluded.ip,
+    request = excluded.request,
+    changed = CASE WHEN status != excluded.status THEN excluded.lastSeen ELSE changed END,
+    status = excluded.status,
+    error = excluded.error,
+    info = excluded.info,
+    lastSeen = excluded.lastSeen,
+    scan = excluded.scan
+"""
+
+
+# Method to turn a result into a results table row, less the scan id
+# The ip column holds an IPv4 address as an integer and an IPv6 one as 16
+# packed bytes, which do not fit a SQLite integer
+# Args: result - List of result values [request, host, port, result] + otherInfo
+#       seen - Time the result was recorded
+def toRow(result,seen):
+    ip = scanAddress.toNumber(result[1])
+    # IPv6 numbers do not fit an SQLite integer, so they are stored packed
+    if ip != None and scanAddress.isV6(ip):
+        ip = scanAddress.pack(result[1])
+    status = scanEngine.statusCode(result[3])
+    error = None
+    if status == None:
+        status = scanStore.STATUS_OTHER
+        error = str(result[3])
+    # A host found down has no single port
+    port = 0 if status == scanEngine.HOST_DOWN else int(result[2])
+    info = json.dumps(list(result[4:])) if len(result) > 4 else None
+    return (result[0], result[1], ip, port, status, error, info, seen)
+
+
+# Class writing results to a SQLite database in batched transactions
+# Results are queued by write and inserted by a background thread, so the
+# engines never wait on the disk. Each scan gets a row in scans and its
+# results in results. state holds the last result of each (host, port) over all scans
+# Args: dbFile - File name of the database
+#       inFile - Input file of the scan
+#       outFile - Output file of the scan
+#       resume - Continue the last unfinished scan of outFile instead of starting a new one
+class Database:
+    def __init__(self,dbFile,inFile,outFile,resume=False):
+        self.connection = sqlite3.connect(dbFile,check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.scanId = None
+        if resume:
+            row = self.connection.execute("SELECT id FROM scans WHERE output = ? AND complete = 0 ORDER BY id DESC LIMIT 1",(outFile,)).fetchone()
+            self.scanId = row[0] if row != None else None
+        if self.scanId == None:
+            with self.connection:
+                self.scanId = self.connection.execute("INSERT INTO scans (input, output, started) VALUES (?,?,?)",(inFile,outFile,time.time())).lastrowid
+        self.batch = []
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopped = False
+        self.error = None
+        self.writer = threading.Thread(target=self.run,daemon=True)
+        self.writer.start()
+
+    # Method to queue one result
+    # Args: result - List of result values [request, host, port, result] + otherInfo
+    def write(self,result):
+        with self.lock:
+            self.batch.append(toRow(result,time.time()))
+            if len(self.batch) >= BATCH_ROWS:
+                self.ready.set()
+
+    # Method run in the writer thread
+    def run(self):
+        while not self.stopped:
+            self.ready.wait(FLUSH_SECONDS)
+            self.ready.clear()
+            self.flush()
+
+    # Method to write the queued results in one transaction
+    def flush(self):
+        with self.lock:
+            batch,self.batch = self.batch,[]
+        if not batch or self.error != None:
+            return
+        try:
+            with self.connection:
+                self.connection.executemany(INSERT_RESULT,((self.scanId,) + row for row in batch))
+                self.connection.executemany(UPSERT_STATE,((row[1], row[3], row[2], row[0], row[4], row[5], row[6], row[7], row[7], row[7], self.scanId) for row in batch))
+        except sqlite3.Error as err:
+            # Keep the error for close, the scan itself goes on
+            self.error = err
+
+    # Method to write every queued result and close the database
+    # Args: complete - True if the scan finished
+    def close(self,complete=True):
+        self.stopped = True
+        self.ready.set()
+        self.writer.join()
+        self.flush()
+        if self.error == None:
+            with self.connection:
+                self.connection.execute("UPDATE scans SET finished = ?, complete = ? WHERE id = ?",(time.time(),int(complete),self.scanId))
+        self.connection.close()
+        if self.error != None:
+            raise self.error
@@ -0,0 +1,113 @@
+# Author: Brenden Sweetman
+# Title: scanDedup
+# Description: Interval index over the input lines so overlapping targets are tested once
+
+
+import bisect
+
+import scanAddress
+
+
+# Class indexing which input lines cover each (ip, port)
+# The address intervals of all lines are cut into disjoint segments, each holding
+# the ids of the lines covering it, so a lookup is one binary search. Hitlist
+# lines are left out of the index, their tests are never dropped
+# Args: intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+class TargetIndex:
+    def __init__(self,intervals):
+        self.requests = [interval[0] for interval in intervals]
+        self.otherInfo = [list(interval[4]) for interval in intervals]
+        # PortList of each line, kept as ranges
+        self.ports = [interval[3] for interval in intervals]
+        # Index of the first test of each line in the getDestList stream
+        self.offsets = []
+        # Address number of the first host of each line, 0 for hostnames
+        self.firsts = []
+        offset = 0
+        self.hostnames = {}
+        # Ids of the hitlist lines
+        self.hitlists = set()
+        events = {}
+        for lineId,(request,start,end,ports,otherInfo) in enumerate(intervals):
+            self.offsets.append(offset)
+            self.firsts.append(start if isinstance(start,int) else 0)
+            if isinstance(start,str):
+                self.hostnames.setdefault(start,[]).append(lineId)
+                offset += len(ports)
+            elif end == None:
+                self.hitlists.add(lineId)
+                offset += len(start) * len(ports)
+            elif end >= start:
+                events.setdefault(start,[]).append(lineId)
+                events.setdefault(end + 1,[]).append(~lineId)
+                offset += (end - start + 1) * len(ports)
+        # Sweep the interval ends, recording the lines active in each segment
+        self.starts = sorted(events)
+        self.covers = []
+        active = set()
+        for point in self.starts:
+            for event in events[point]:
+                if event >= 0:
+                    active.add(event)
+                else:
+                    active.discard(~event)
+            self.covers.append(sorted(active))
+
+    # Method to get the input line a test came from
+    # Args: index - Index of the test in the getDestList stream
+    def lineOf(self,index):
+        return bisect.bisect_right(self.offsets,index) - 1
+
+    # Method to get the index a line's test of an (ip, port) has in the getDestList stream
+    # Args: lineId - Id of a line covering the (ip, port)
+    #       ip - Address number from scanAddress.toNumber, None for a hostname
+    #       port - Int or String of port
+    def testIndex(self,lineId,ip,port):
+        hostNumber = ip - self.firsts[lineId] if ip != None else 0
+        ports = self.ports[lineId]
+        return self.offsets[lineId] + hostNumber * len(ports) + ports.index(port)
+
+    # Method to get the ids of the lines covering an (ip, port), in input order
+    # Args: host - String of Hostname or IP
+    #       port - Int of port
+    def covering(self,host,port):
+        ip = scanAddress.toNumber(host)
+        if ip == None:
+            lineIds = self.hostnames.get(host,())
+        else:
+            segment = bisect.bisect_right(self.starts,ip) - 1
+            lineIds = self.covers[segment] if segment >= 0 else ()
+        return [lineId for lineId in lineIds if port in self.ports[lineId]]
+
+    # Generator dropping tests of an (ip, port) already covered by an earlier line
+    # Args: tests - Iterable of (index, [request, host, port] + otherInfo) pairs
+    def skipDuplicates(self,tests):
+        for index,test in tests:
+            if self.lineOf(index) in self.hitlists:
+                yield index,test
+                continue
+            lineIds = self.covering(test[1],int(test[2]))
+            if not lineIds or lineIds[0] >= self.lineOf(index):
+                yield index,test
+
+    # Method to wrap a callback so each result is reported for every line covering it
+    # Each line's row is reported with the index of that line's own test, so
+    # sorting and the resume journal see it as if the line had been tested
+    # Args: callback - Function called with (index, result)
+    def fanOut(self,callback):
+
+        # Report a result once per covering line
+        def onResult(index,result):
+            if result[2] == "*" or self.lineOf(index) in self.hitlists:
+                lineIds = ()
+            else:
+                lineIds = self.covering(result[1],int(result[2]))
+            if not lineIds:
+                callback(index,result)
+            ip = scanAddress.toNumber(result[1])
+            for lineId in lineIds:
+                # Every line has the same number of otherInfo values, so any
+                # values after them (such as banners) are kept as is
+                otherInfo = self.otherInfo[lineId]
+                callback(self.testIndex(lineId,ip,result[2]),[self.requests[lineId]] + result[1:4] + otherInfo + result[4 + len(otherInfo):])
+        return onResult
@@ -0,0 +1,143 @@
+# Author: Brenden Sweetman
+# Title: scanDiff
+# Description: Differential rescans probing only what is new, stale or was listening, with a change report
+
+
+import csv
+import os
+import sqlite3
+import threading
+import time
+
+import scanAddress
+import scanEngine
+import scanStore
+
+
+# Default age after which a previous result is probed again (Hours)
+STALE_HOURS = 24
+# Header line for the change report
+DIFF_HEADER = "Request, Destination, Port, Change, Previous, Result\n"
+
+LISTENING = scanEngine.STATUS_CODES[" LISTENING"]
+NOT_LISTENING = scanEngine.STATUS_CODES["NOT LISTENING"]
+FILTERED = scanEngine.STATUS_CODES["FILTERED"]
+
+
+# Class holding the previous status and last seen time of each (host, port)
+# IPv4 and IPv6 keys are packed into one int with the port and each value is the
+# seen time in seconds shifted left over the status code, so a large estate
+# costs two ints per entry
+class Previous:
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Method to get the key of a (host, port)
+    # Args: host - String of Hostname or IP
+    #       port - Int of port, 0 for a host found down
+    def key(self,host,port):
+        ip = scanAddress.toNumber(host)
+        if ip == None:
+            return (host, port)
+        return ip << 16 | port
+
+    # Method to add the previous result of a (host, port)
+    # Args: host - String of Hostname or IP
+    #       port - Int of port, 0 for a host found down
+    #       status - Status code from scanEngine.RESULTS or scanStore.STATUS_OTHER
+    #       seen - Time the result was seen
+    def add(self,host,port,status,seen):
+        self.entries[self.key(host,port)] = int(seen) << 8 | status
+
+    # Method to get the previous (status, seen) of a (host, port), or None
+    # Args: host - String of Hostname or IP
+    #       port - Int of port, 0 for a host found down
+    def get(self,host,port):
+        value = self.entries.get(self.key(host,port))
+        return None if value == None else (value & 0xFF, value >> 8)
+
+    # Generator keeping only the tests worth probing again
+    # New targets, ports that were LISTENING and results older than maxAge are
+    # probed. Fresh results of other ports, and ports of hosts recently found
+    # down, are skipped
+    # Args: tests - Iterable of (index, [request, host, port] + otherInfo) pairs
+    #       maxAge - Seconds after which a previous result is stale
+    def select(self,tests,maxAge):
+        oldest = time.time() - maxAge
+        for index,test in tests:
+            previous = self.get(test[1],int(test[2]))
+            if previous == None:
+                previous = self.get(test[1],0)
+                if previous != None and previous[0] != scanEngine.HOST_DOWN:
+                    previous = None
+            if previous == None or previous[0] == LISTENING or previous[1] < oldest:
+                yield index,test
+
+# Method to load the previous results of a scan
+# Args: path - File name of a SQLite database from --db or a results csv
+def loadPrevious(path):
+    previous = Previous()
+    if path.endswith(".csv"):
+        # A csv has no times, so every result is as old as the file
+        seen = os.path.getmtime(path)
+        store = scanStore.loadCsv(path)
+        for row in range(len(store)):
+            host = store.row(row)[1]
+            previous.add(host,store.ports[row],store.statuses[row],seen)
+        return previous
+    connection = sqlite3.connect("file:{}?mode=ro".format(path),uri=True)
+    try:
+        for host,port,status,seen in connection.execute("SELECT host, port, status, lastSeen FROM state"):
+            previous.add(host,port,status,seen)
+    finally:
+        connection.close()
+    return previous
+
+
+# Class writing the ports whose status changed since the previous results
+# OPENED - LISTENING now and not before (or never seen before)
+# CLOSED - NOT LISTENING now and LISTENING before
+# FILTERED - FILTERED now and answering before
+# Args: outFile - File name of the change report csv
+#       previous - Previous results
+class DiffReport:
+    def __init__(self,outFile,previous):
+        self.previous = previous
+        self.file = open(outFile,"w",newline="")
+        self.file.write(DIFF_HEADER)
+        self.writer = csv.writer(self.file,lineterminator="\n")
+        self.counts = {"OPENED": 0, "CLOSED": 0, "FILTERED": 0}
+        # Results may be reported from the pool and the main thread at once
+        self.lock = threading.Lock()
+
+    # Method to compare one result with its previous status
+    # Args: result - List of result values [request, host, port, result] + otherInfo
+    def record(self,result):
+        status = scanEngine.statusCode(result[3])
+        if status not in (LISTENING, NOT_LISTENING, FILTERED):
+            return
+        previous = self.previous.get(result[1],int(result[2]))
+        before = previous[0] if previous != None else None
+        if status == LISTENING and before != LISTENING:
+            change = "OPENED"
+        elif status == NOT_LISTENING and before == LISTENING:
+            change = "CLOSED"
+        elif status == FILTERED and before in (LISTENING, NOT_LISTENING):
+            change = "FILTERED"
+        else:
+            return
+        name = scanEngine.RESULTS[before] if before != None and before != scanStore.STATUS_OTHER else ""
+        with self.lock:
+            self.counts[change] += 1
+            self.writer.writerow(result[:3] + [change, name, result[3]])
+
+    # Method to close the report
+    def close(self):
+        self.file.close()
+
+    # Method to format the change counts
+    def summary(self):
+        return "Changes: {} opened, {} closed, {} newly filtered".format(self.counts["OPENED"], self.counts["CLOSED"], self.counts["FILTERED"])
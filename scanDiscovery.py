@@ -0,0 +1,195 @@
+# Author: Brenden Sweetman
+# Title: scanDiscovery
+# Description: Host discovery pre-pass so dead addresses in subnets and ranges are not port scanned
+
+
+import asyncio
+import bisect
+import errno
+import os
+import selectors
+import socket
+import time
+
+import scanAddress
+import scanEngine
+import scanInput
+import scanSchedule
+import scanSocket
+import scanTiming
+
+
+# Default ports probed to decide if a host is alive
+DISCOVERY_PORTS = ["22", "80", "443"]
+
+
+# Class holding a set of hosts
+# Addresses are kept as a 256 bit bitmap per address less its last byte, a
+# /24 for IPv4, so the live hosts of large subnets stay small. Hostnames are kept in a set
+class HostSet:
+    def __init__(self):
+        self.bitmaps = {}
+        self.hosts = set()
+
+    # Method to add a host
+    # Args: host - String of Hostname or IP
+    def add(self,host):
+        packed = scanAddress.pack(host)
+        if packed == None:
+            self.hosts.add(host)
+            return
+        bitmap = self.bitmaps.get(packed[:-1])
+        if bitmap == None:
+            bitmap = self.bitmaps[packed[:-1]] = bytearray(32)
+        bitmap[packed[-1] >> 3] |= 1 << (packed[-1] & 7)
+
+    # Method to test if a host was added
+    # Args: host - String of Hostname or IP
+    def contains(self,host):
+        packed = scanAddress.pack(host)
+        if packed == None:
+            return host in self.hosts
+        bitmap = self.bitmaps.get(packed[:-1])
+        return bitmap != None and bool(bitmap[packed[-1] >> 3] & (1 << (packed[-1] & 7)))
+
+
+# Method to test if a host answers a connect on any of a few ports
+# An accepted or refused connect both mean the host is alive. A probe that
+# failed for lack of local sockets says nothing about the host, so if no
+# other probe answered its error is returned instead, to be retried
+# Args: request - String of orginal rage subnet, or IP requested in csv
+#       host - String of IP to test
+#       ports - List of ports to probe
+#       otherInfo - A list of other information from the original csv
+#       timeout - Number of seconds to wait with no reply
+def discoverHost(request,host,ports,otherInfo,timeout):
+    alive = False
+    local = None
+    # The selector takes a descriptor too
+    try:
+        selector = selectors.DefaultSelector()
+    except OSError as err:
+        return [request, host, ports, err] + otherInfo
+    try:
+        # Start a non-blocking connect on every discovery port at once
+        for port in ports:
+            try:
+                sock = scanSocket.SOCKETS.open(scanAddress.family(host))
+            except OSError as err:
+                local = err
+                break
+            sock.setblocking(False)
+            err = sock.connect_ex((host,int(port)))
+            if err in (0, errno.ECONNREFUSED):
+                alive = True
+            if err in scanSocket.LOCAL_ERRORS:
+                local = OSError(err, os.strerror(err))
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                selector.register(sock, selectors.EVENT_WRITE)
+            else:
+                scanSocket.SOCKETS.close(sock,err == 0)
+        deadline = time.monotonic() + scanTiming.RTT.timeout(host,timeout if timeout != None else 10)
+        # Wait for the first answer or the timeout
+        while not alive and selector.get_map() and time.monotonic() < deadline:
+            for key,_ in selector.select(deadline - time.monotonic()):
+                err = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err in (0, errno.ECONNREFUSED):
+                    alive = True
+                selector.unregister(key.fileobj)
+                scanSocket.SOCKETS.close(key.fileobj,err == 0)
+    finally:
+        # Close any connect still waiting
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    return [request, host, ports, alive or local or False] + otherInfo
+
+# Coroutine to test if a host answers a connect on any of a few ports
+# Args: see discoverHost
+async def asyncDiscoverHost(request,host,ports,otherInfo,timeout):
+    alive = False
+    local = None
+    probes = [asyncio.ensure_future(scanEngine.asyncTestPort(request,host,port,[],timeout)) for port in ports]
+    try:
+        # Stop at the first answer
+        for probe in asyncio.as_completed(probes):
+            result = await probe
+            if result[3] in (" LISTENING", "NOT LISTENING"):
+                alive = True
+                break
+            if scanSocket.isLocalError(result):
+                local = result[3]
+    finally:
+        for probe in probes:
+            probe.cancel()
+    return [request, host, ports, alive or local or False] + otherInfo
+
+# Generator of one discovery test per address of a subnet, range or hitlist line
+# Hosts are taken straight from the line intervals, leaving the ports out.
+# Lines where the request is the host itself (single IPs and hostnames) are not discovered
+# Args: intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+#       ports - List of ports to probe
+#       done - Optional DoneTests of tests finished by an interrupted run
+def getDiscoveryList(intervals,ports,done=None):
+    offsets,total = scanSchedule.getOffsets(intervals)
+    seen = HostSet()
+    for offset,(request,start,end,linePorts,otherInfo) in zip(offsets,intervals):
+        if isinstance(start,str) or start == end and scanAddress.isAddress(request):
+            continue
+        if isinstance(start,scanInput.Hitlist):
+            hosts = iter(start)
+        else:
+            hosts = (scanAddress.toAddress(ip) for ip in range(start,end + 1))
+        for hostNumber,host in enumerate(hosts):
+            if seen.contains(host):
+                continue
+            # Hosts whose tests all finished in an interrupted run need no probe
+            first = offset + hostNumber * len(linePorts)
+            if done != None and all(done.contains(index) for index in range(first,first + len(linePorts))):
+                continue
+            seen.add(host)
+            yield [request,host,ports]
+
+# Method to run discovery and collect the live hosts
+# Args: intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+#       ports - List of ports to probe
+#       engine - Connect engine, "thread" or "async"
+#       timeout - Number of seconds to wait with no reply
+#       poolsize - Size of the pool running the discovery, in sockets for the async engine
+#       done - Optional DoneTests of tests finished by an interrupted run
+def runDiscovery(intervals,ports,engine,timeout,poolsize,done=None):
+    live = HostSet()
+
+    # Mark a host as live. A host whose probes still lacked local sockets
+    # after the retries is kept as live, so its ports are scanned
+    def found(index,result):
+        if result[3] is True or scanSocket.isLocalError(result):
+            live.add(result[1])
+
+    discoveryList = enumerate(getDiscoveryList(intervals,ports,done))
+    if engine == "async":
+        # Every host holds a socket per discovery port, so the window counts sockets
+        poolsize = max((poolsize or scanEngine.ASYNC_POOLSIZE) // len(ports), 1)
+        scanEngine.runAsync(discoveryList,timeout,poolsize,found,asyncDiscoverHost)
+    else:
+        scanEngine.runThreaded(discoverHost,((index,(test[0],test[1],ports,[],timeout)) for index,test in discoveryList),poolsize,found)
+    return live
+
+# Generator skipping the port tests of hosts found dead by discovery
+# Each dead host is reported once per line through callback instead of once
+# per port, with the index of the host's test on the line's first port. Any
+# order or subset of the tests then reports it once, and a resumed run finds
+# it in the journal
+# Args: tests - Iterable of (index, [request, host, port] + otherInfo) pairs
+#       live - HostSet of live hosts from runDiscovery
+#       callback - Function called with (index, result) for each dead host
+#       intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+def skipDown(tests,live,callback,intervals):
+    offsets,total = scanSchedule.getOffsets(intervals)
+    for index,test in tests:
+        if test[0] == test[1] or live.contains(test[1]):
+            yield index,test
+            continue
+        lineId = bisect.bisect_right(offsets,index) - 1
+        if (index - offsets[lineId]) % len(intervals[lineId][3]) == 0:
+            callback(index,[test[0],test[1],"*",scanEngine.RESULTS[scanEngine.HOST_DOWN]] + list(test[3:]))
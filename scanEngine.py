@@ -0,0 +1,228 @@
+# Author: Brenden Sweetman
+# Title: scanEngine
+# Description: Connect engines (thread pool and asyncio) for the Multi-Threaded port scanners
+
+
+import asyncio
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import scanAddress
+import scanMetrics
+import scanResolver
+import scanSocket
+import scanTiming
+import scanTune
+
+
+# Default number of threads in the connect pool
+THREAD_POOLSIZE = 5
+# Default number of connects allowed in flight on the event loop
+ASYNC_POOLSIZE = 1000
+# Number of queued tests allowed per pool thread before target expansion waits
+QUEUE_DEPTH = 4
+# Result strings indexed by status code
+RESULTS = (" LISTENING", "NOT LISTENING", "FILTERED", "Hostname could not be resolved", "HOST DOWN")
+# Status code of a host found dead by discovery, reported once for all ports
+HOST_DOWN = 4
+# Status codes for each result string
+STATUS_CODES = {result: code for code,result in enumerate(RESULTS)}
+
+
+# Method to turn a connect error into a result string
+# Args: err - Exception raised by the connect attempt
+def classifyError(err):
+    # Collect DNS resolve error for hostname
+    if isinstance(err, socket.gaierror):
+        return "Hostname could not be resolved"
+    # Collect timeout error if no reply recived
+    if isinstance(err, (socket.timeout, asyncio.TimeoutError)):
+        return "FILTERED"
+    # Collect conection refused error if destination replys with a refused ack packet
+    if isinstance(err, ConnectionRefusedError):
+        return "NOT LISTENING"
+    # Any other error is reported as is
+    return err
+
+# Method to get the status code of a result
+# Args: result - Result string (or error) returned by a port test
+def statusCode(result):
+    # Other errors have no status code
+    return STATUS_CODES.get(result) if isinstance(result, str) else None
+
+# Method to perform a non-blocking port test on the event loop
+# Args: request - String of orginal rage subnet, or IP requested in csv
+#       host - String of Hostname or IP to test connection
+#       port - Int of for port used for connection
+#       otherInfo - A list of other information from the original csv
+#       timeout - Number of seconds to wait with no reply
+async def asyncTestPort(request,host,port,otherInfo,timeout):
+    loop = asyncio.get_running_loop()
+    # Look up the address resolved ahead of the scan
+    address = await scanResolver.asyncGetAddress(host)
+    # Report hostnames that could not be resolved without opening a socket
+    if address == None:
+        return [request, host, port, "Hostname could not be resolved"] + otherInfo
+    # Create new non-blocking TCP socket for connection, IPv4 or IPv6 as the address is
+    try:
+        sock = scanSocket.SOCKETS.open(scanAddress.family(address))
+    # Running out of file descriptors is reported like any other error
+    except OSError as err:
+        return [request, host, port, err] + otherInfo
+    sock.setblocking(False)
+    start = loop.time()
+    # A cancelled connect leaves no result, so the socket is closed without reuse
+    result = None
+    try:
+        # Attempt Socket connection on host and port
+        await asyncio.wait_for(loop.sock_connect(sock,(address,int(port))),
+                               scanTiming.RTT.timeout(address,timeout if timeout != None else 10))
+        result = " LISTENING"
+    except (OSError, asyncio.TimeoutError) as err:
+        result = classifyError(err)
+    finally:
+        # Close socket and end connection
+        scanSocket.SOCKETS.close(sock,result == " LISTENING")
+    # Feed the round trip time of answered connects to the adaptive timeouts
+    if result == " LISTENING" or result == "NOT LISTENING":
+        scanTiming.RTT.sample(address,loop.time() - start)
+    return [request, host, port, result] + otherInfo
+
+# Coroutine to run every test with a bounded number of connects in flight
+# Args: tests - Iterable of (index, [request, host, port] + otherInfo) pairs, or (None, seconds) pauses
+#       timeout - Number of seconds to wait with no reply
+#       poolsize - Max number of connects in flight
+#       callback - Function called with (index, result) as each test completes
+#       testFunc - Coroutine performing one test. Default asyncTestPort
+async def asyncScan(tests,timeout,poolsize,callback,testFunc=asyncTestPort):
+    # Let the tuner size the window if asked, starting from poolsize
+    tuner = scanTune.TUNER if scanTune.TUNER.enabled else None
+    if tuner != None:
+        tuner.start(poolsize,scanTune.ASYNC_CEILING)
+        acquire = tuner.asyncAcquire
+        release = tuner.release
+    else:
+        window = asyncio.Semaphore(poolsize)
+        acquire = window.acquire
+        release = window.release
+    pending = set()
+
+    # Run one test and free its slot in the window
+    async def runTest(index,test):
+        try:
+            for retry in range(scanSocket.LOCAL_RETRIES + 1):
+                scanMetrics.METRICS.probeStarted()
+                start = time.monotonic()
+                result = await testFunc(test[0],test[1],test[2],list(test[3:]),timeout)
+                scanMetrics.METRICS.probeFinished(time.monotonic() - start)
+                if tuner != None:
+                    tuner.observe(result)
+                # Retry a probe that failed for lack of local resources after a backoff
+                wait = scanSocket.SOCKETS.backoff(result)
+                if wait == 0 or retry == scanSocket.LOCAL_RETRIES:
+                    break
+                release()
+                await asyncio.sleep(wait)
+                await acquire()
+            callback(index,result)
+        finally:
+            release()
+
+    for index,test in tests:
+        # A rate limited stream asks for a pause as (None, seconds)
+        if index == None:
+            await asyncio.sleep(test)
+            continue
+        # Wait for a free slot before starting the next connect
+        await acquire()
+        task = asyncio.ensure_future(runTest(index,test))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    # Wait for the remaining connects to finish
+    if pending:
+        await asyncio.gather(*pending)
+
+# Method to run all tests on one event loop
+# Args: tests - Iterable of (index, [request, host, port] + otherInfo) pairs
+#       timeout - Number of seconds to wait with no reply
+#       poolsize - Max number of connects in flight. Default ASYNC_POOLSIZE
+#       callback - Function called with (index, result) as each test completes
+#       testFunc - Coroutine performing one test. Default asyncTestPort
+def runAsync(tests,timeout,poolsize,callback,testFunc=asyncTestPort):
+    asyncio.run(asyncScan(tests,timeout,poolsize or ASYNC_POOLSIZE,callback,testFunc))
+
+# Method to run all tests in a thread pool fed through a bounded queue
+# Args: testFunc - Function performing one test
+#       argsList - Iterable of (index, argument tuple) pairs for testFunc, or (None, seconds) pauses
+#       poolsize - Number of threads in the pool. Default THREAD_POOLSIZE
+#       callback - Function called with (index, result) as each test completes
+def runThreaded(testFunc,argsList,poolsize,callback):
+    poolsize = poolsize or THREAD_POOLSIZE
+    # Let the tuner size the window if asked, starting from poolsize. The pool
+    # holds a thread for the largest window and the tuner holds back the rest
+    tuner = scanTune.TUNER if scanTune.TUNER.enabled else None
+    if tuner != None:
+        tuner.start(poolsize,scanTune.THREAD_CEILING)
+        poolsize = tuner.ceiling
+    pool = ThreadPool(poolsize)
+    # Only allow a few tests per thread to wait in the pool queue so the
+    # target generator is never drained faster than tests complete
+    queue = threading.BoundedSemaphore(poolsize * QUEUE_DEPTH)
+    errors = []
+
+    # Count each probe and time it
+    def timedTest(*args):
+        for retry in range(scanSocket.LOCAL_RETRIES + 1):
+            if tuner != None:
+                tuner.acquire()
+            scanMetrics.METRICS.probeStarted()
+            start = time.monotonic()
+            try:
+                result = testFunc(*args)
+            finally:
+                if tuner != None:
+                    tuner.release()
+            scanMetrics.METRICS.probeFinished(time.monotonic() - start)
+            if tuner != None:
+                tuner.observe(result)
+            # Retry a probe that failed for lack of local resources after a backoff
+            wait = scanSocket.SOCKETS.backoff(result)
+            if wait == 0 or retry == scanSocket.LOCAL_RETRIES:
+                return result
+            time.sleep(wait)
+
+    # Hand a finished result to the caller and free its queue slot
+    def done(index,result):
+        try:
+            callback(index,result)
+        finally:
+            queue.release()
+
+    # Keep the first error raised by a test and free its queue slot
+    def failed(err):
+        errors.append(err)
+        queue.release()
+
+    try:
+        for index,args in argsList:
+            # A rate limited stream asks for a pause as (None, seconds)
+            if index == None:
+                time.sleep(args)
+                continue
+            queue.acquire()
+            if errors:
+                break
+            pool.apply_async(timedTest, args=args,
+                             callback=lambda result, index=index: done(index,result),
+                             error_callback=failed)
+    except BaseException:
+        # Stop handing results to the caller if the scan is interrupted
+        pool.terminate()
+        raise
+    # End pool
+    pool.close()
+    pool.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,281 @@
+# Author: Brenden Sweetman
+# Title: scanInput
+# Description: Bulk loader for large target files and IPv4 or IPv6 hitlists with compact port ranges and per line validation
+
+
+import bisect
+import csv
+import ipaddress
+import mmap
+import os
+import re
+
+import scanAddress
+
+
+# Bytes of the input file read per chunk
+CHUNK_SIZE = 1 << 24
+# Bytes the loaders pull out of every line, keeping ASCII 1-126
+BAD_BYTES = bytes([0]) + bytes(range(127, 256))
+# Max number of distinct port lists kept for reuse between lines
+PORT_CACHE_SIZE = 10000
+# Max number of addresses in an IPv6 range or subnet, larger ones need a hitlist
+V6_MAX_HOSTS = 1 << 24
+# Mark of an input line target naming a hitlist file, such as @hitlist.txt
+HITLIST_MARK = "@"
+
+# Same classification getDestList uses for ranges and subnets, IPv4 or IPv6
+RANGE = re.compile(r"\d+-\d+|[0-9A-Fa-f:]-[0-9A-Fa-f]*:")
+SUBNET = re.compile(r"[0-9A-Fa-f:]\/\d+")
+HOSTNAME = re.compile(r"[A-Za-z0-9_]([A-Za-z0-9_.-]{0,252})")
+
+
+# Class of the ports of one input line, kept as ranges instead of a string per port
+# Behaves as a sequence of port strings in input order, so getDestList and
+# getTest use it like the split list it replaces
+# Args: ranges - List of inclusive (first, last) port ranges in input order
+class PortList:
+    def __init__(self,ranges):
+        self.firsts = [first for first,last in ranges]
+        self.lasts = [last for first,last in ranges]
+        # Position of the first port of each range
+        self.offsets = []
+        total = 0
+        for first,last in ranges:
+            self.offsets.append(total)
+            total += last - first + 1
+        self.total = total
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self,position):
+        if position < 0:
+            position += self.total
+        if not 0 <= position < self.total:
+            raise IndexError("port position out of range")
+        rangeId = bisect.bisect_right(self.offsets,position) - 1
+        return str(self.firsts[rangeId] + position - self.offsets[rangeId])
+
+    def __iter__(self):
+        for first,last in zip(self.firsts,self.lasts):
+            for port in range(first,last + 1):
+                yield str(port)
+
+    def __contains__(self,port):
+        port = int(port)
+        return any(first <= port <= last for first,last in zip(self.firsts,self.lasts))
+
+    def __repr__(self):
+        return "PortList({})".format(self.ranges())
+
+    # Method to get the position of a port, the first if it is listed twice
+    # Args: port - Int or String of port
+    def index(self,port):
+        port = int(port)
+        for first,last,offset in zip(self.firsts,self.lasts,self.offsets):
+            if first <= port <= last:
+                return offset + port - first
+        raise ValueError("port {} not in list".format(port))
+
+    # Method to get the list of (first, last) port ranges
+    def ranges(self):
+        return list(zip(self.firsts,self.lasts))
+
+# Port lists already parsed, by text and separator
+PORT_CACHE = {}
+
+# Method to parse a list of ports and port ranges such as 22,80,8000-8100
+# Lines often share the same ports, so parsed lists are reused
+# Args: text - String of ports, or a PortList which is returned as is
+#       separator - String between the ports
+def parsePorts(text,separator):
+    if isinstance(text,PortList):
+        return text
+    ports = PORT_CACHE.get((text,separator))
+    if ports != None:
+        return ports
+    ranges = []
+    for item in text.split(separator):
+        first,_,last = item.strip().partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if not 0 < first <= last <= 65535:
+            raise ValueError("bad port " + item.strip())
+        ranges.append((first,last))
+    ports = PortList(ranges)
+    if len(PORT_CACHE) < PORT_CACHE_SIZE:
+        PORT_CACHE[(text,separator)] = ports
+    return ports
+
+# Method to check the target of an input line
+# Args: host - String of Hostname, IP, IP range or subnet
+def checkHost(host):
+    # Only run the patterns on hosts that could match them
+    if "-" in host and RANGE.search(host):
+        first,_,last = host.partition("-")
+        first = addressNumber(first)
+        last = addressNumber(last)
+        if scanAddress.isV6(first) != scanAddress.isV6(last):
+            raise ValueError("range mixes IPv4 and IPv6")
+        if first > last:
+            raise ValueError("range ends before it starts")
+        if scanAddress.isV6(first) and last - first >= V6_MAX_HOSTS:
+            raise ValueError("IPv6 range too large to sweep, use a hitlist")
+    elif "/" in host and SUBNET.search(host):
+        network = ipaddress.ip_network(host,False)
+        if network.version == 6 and network.num_addresses > V6_MAX_HOSTS:
+            raise ValueError("IPv6 subnet too large to sweep, use a hitlist")
+    elif ":" in host or host.replace(".","").isdigit():
+        addressNumber(host)
+    elif not HOSTNAME.fullmatch(host):
+        raise ValueError("bad hostname")
+
+# Method to get the number of an IPv4 or IPv6 address, comparable in address order
+# Args: address - String of IP
+def addressNumber(address):
+    number = scanAddress.toNumber(address)
+    if number == None:
+        raise ValueError("bad address " + address)
+    return number
+
+
+# Class of the addresses of a hitlist, 16 packed bytes per address
+# IPv4 addresses are kept as ::ffff:a.b.c.d. Behaves as a sequence of
+# address strings, so getDestList and getTest use it like a range
+# Args: packed - Optional bytes of packed addresses
+class Hitlist:
+    def __init__(self,packed=None):
+        self.packed = bytearray(packed or b"")
+
+    def __len__(self):
+        return len(self.packed) // 16
+
+    def __getitem__(self,position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("hitlist position out of range")
+        return scanAddress.unpack(self.packed[position * 16:position * 16 + 16])
+
+    def __iter__(self):
+        for offset in range(0,len(self.packed),16):
+            yield scanAddress.unpack(self.packed[offset:offset + 16])
+
+    # Method to add one address
+    # Args: address - String of IPv4 or IPv6 address
+    def append(self,address):
+        packed = scanAddress.pack(address)
+        if packed == None:
+            raise ValueError("bad address " + address)
+        self.packed += packed
+
+# Hitlists already loaded, by file name
+HITLISTS = {}
+
+# Method to test if an input line target names a hitlist file
+# Args: host - String of the target
+def isHitlist(host):
+    return host.startswith(HITLIST_MARK)
+
+# Method to read a hitlist file of one address per line, streaming it into packed storage
+# Blank lines and lines starting with # are skipped
+# Args: path - File name of the hitlist
+#       onError - Function called with (line number, line, reason) for each bad line
+def loadHitlist(path,onError):
+    hitlist = Hitlist()
+    for count,line in enumerate(readLines(path), start=1):
+        address = line.strip()
+        if not address or address.startswith("#"):
+            continue
+        try:
+            hitlist.append(address)
+        except ValueError as err:
+            onError(count,line,"in hitlist " + path + ", " + str(err))
+    return hitlist
+
+# Method to get the hitlist of an input line target such as @hitlist.txt, loading it once
+# Args: host - String of the target
+#       onError - Function called with (line number, line, reason) for each bad line. Default skip them quietly
+def getHitlist(host,onError=None):
+    path = host[len(HITLIST_MARK):]
+    hitlist = HITLISTS.get(path)
+    if hitlist == None:
+        hitlist = HITLISTS[path] = loadHitlist(path,onError or (lambda count,line,reason: None))
+    return hitlist
+
+# Method to check the target of an input line, loading it if it names a hitlist
+# Args: host - String of the target
+#       hitlists - True if targets may name hitlist files
+#       onError - Function called with (line number, line, reason) for each bad hitlist line
+def checkTarget(host,hitlists,onError):
+    if not isHitlist(host):
+        checkHost(host)
+    elif not hitlists:
+        raise ValueError("hitlists can not be used here")
+    else:
+        try:
+            getHitlist(host,onError)
+        except OSError as err:
+            raise ValueError("can not read hitlist: " + str(err))
+
+# Generator of the lines of a file with bad bytes pulled out
+# The file is mapped and cleaned a chunk at a time with bytes.translate
+# Args: inFile - File name of the input
+def readLines(inFile):
+    with open(inFile,"rb") as inData:
+        if os.fstat(inData.fileno()).st_size == 0:
+            return
+        with mmap.mmap(inData.fileno(),0,access=mmap.ACCESS_READ) as data:
+            start = 0
+            while start < len(data):
+                # Cut each chunk at a line end
+                end = data.find(b"\n",min(start + CHUNK_SIZE,len(data)) - 1)
+                end = len(data) if end == -1 else end + 1
+                lines = data[start:end].translate(None,BAD_BYTES).decode("ascii").split("\n")
+                # Drop the empty piece after the last line end
+                if lines[-1] == "":
+                    lines.pop()
+                yield from lines
+                start = end
+
+# Generator of the valid lines of a portScanMT input file as [host, PortList]
+# A host of @FILE names a hitlist of addresses, all scanned on the line's ports
+# Args: inFile - File name of the input
+#       onError - Function called with (line number, line, reason) for each bad line
+def loadTargets(inFile,onError):
+    return parseTargets(readLines(inFile),onError,True)
+
+# Generator of the valid lines in the portScanMT input format as [host, PortList]
+# Args: lines - Iterable of "host ports" strings
+#       onError - Function called with (line number, line, reason) for each bad line
+#       hitlists - True if lines may name hitlist files. Default False
+def parseTargets(lines,onError,hitlists=False):
+    for count,line in enumerate(lines, start=1):
+        split1 = line.rstrip("\r").split(" ")
+        if len(split1) != 2:
+            onError(count,line,"expected a host and a list of ports")
+            continue
+        try:
+            checkTarget(split1[0],hitlists,onError)
+            yield [split1[0], parsePorts(split1[1],",")]
+        except ValueError as err:
+            onError(count,line,str(err))
+
+# Generator of the valid rows of a portScanMTcsv input file as [host, PortList] + otherInfo
+# The first row is the header. A host of @FILE names a hitlist
+# Args: inFile - File name of the input csv
+#       onError - Function called with (line number, row, reason) for each bad row
+def loadCsvTargets(inFile,onError):
+    reader = csv.reader(readLines(inFile))
+    # Skip header
+    next(reader,None)
+    for row in reader:
+        if len(row) != 6:
+            onError(reader.line_num,",".join(row),"expected 6 fields")
+            continue
+        try:
+            checkTarget(row[0],True,onError)
+            yield [row[0], parsePorts(row[1],";")] + row[2:]
+        except ValueError as err:
+            onError(reader.line_num,",".join(row),str(err))
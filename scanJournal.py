@@ -0,0 +1,193 @@
+# Author: Brenden Sweetman
+# Title: scanJournal
+# Description: Append-only journal of finished probes so long scans can be resumed
+
+
+import csv
+import hashlib
+import os
+import struct
+
+import scanEngine
+import scanInput
+import scanOutput
+import scanStore
+
+
+# Header of a journal: magic and a SHA-256 fingerprint of the input and options
+HEADER = struct.Struct(">8s32s")
+MAGIC = b"SCANJNL1"
+# Record of a finished test: type, test index, status code
+TEST_RECORD = struct.Struct(">BQB")
+# Record types
+TYPE_TEST = 8
+# Options changing the test indices or the output rows a journal refers to
+FINGERPRINT_OPTIONS = ("sort","banners")
+
+
+# Class holding the set of finished tests by their index in the getDestList stream
+# The index names the input line as well as the (ip, port), so lines
+# covering the same (ip, port) are resumed on their own. Indices are kept as
+# a 256 bit bitmap per block of 256
+class DoneTests:
+    def __init__(self):
+        self.bitmaps = {}
+        self.count = 0
+
+    # Method to mark a test as finished
+    # Args: index - Index of the test
+    def add(self,index):
+        bitmap = self.bitmaps.get(index >> 8)
+        if bitmap == None:
+            bitmap = self.bitmaps[index >> 8] = bytearray(32)
+        last = index & 0xFF
+        if not bitmap[last >> 3] & (1 << (last & 7)):
+            bitmap[last >> 3] |= 1 << (last & 7)
+            self.count += 1
+
+    # Method to test if a test has finished
+    # Args: index - Index of the test
+    def contains(self,index):
+        bitmap = self.bitmaps.get(index >> 8)
+        last = index & 0xFF
+        return bitmap != None and bool(bitmap[last >> 3] & (1 << (last & 7)))
+
+
+# Method to fingerprint the input and options a journal's test indices refer to
+# Args: scriptName - Name of the script, which decides how lines are parsed
+#       inFile - File name of the input
+#       intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+#       args - Parsed command line arguments
+def fingerprint(scriptName,inFile,intervals,args):
+    digest = hashlib.sha256(scriptName.encode())
+    with open(inFile,"rb") as inputFile:
+        for block in iter(lambda: inputFile.read(1 << 16),b""):
+            digest.update(block)
+    # Hitlist files are expanded into the test indices too
+    for interval in intervals:
+        if isinstance(interval[1],scanInput.Hitlist):
+            digest.update(bytes(interval[1].packed))
+    for name in FINGERPRINT_OPTIONS:
+        digest.update("{}={!r};".format(name, getattr(args,name)).encode())
+    return digest.digest()
+
+# Method to check a journal was written for the same input and options
+# Test indices only mean the same tests for the same input and options. An
+# empty journal, cut short before its header reached disk, holds no tests
+# Args: journalFile - File name of the journal
+#       digest - fingerprint of the input and options of this run
+def checkJournal(journalFile,digest):
+    with open(journalFile,"rb") as journal:
+        header = journal.read(HEADER.size)
+    if header and header != HEADER.pack(MAGIC,digest):
+        raise ValueError("journal " + journalFile + " was written for a different input file or options, can not resume")
+
+# Method to load the finished tests from a journal
+# Args: journalFile - File name of the journal
+def loadJournal(journalFile):
+    done = DoneTests()
+    if not os.path.exists(journalFile):
+        return done
+    with open(journalFile,"rb") as journal:
+        data = journal.read()
+    # Walk the records, ignoring a record cut short by a crash
+    for offset in range(HEADER.size,len(data) - TEST_RECORD.size + 1,TEST_RECORD.size):
+        recordType,index,_ = TEST_RECORD.unpack_from(data,offset)
+        if recordType != TYPE_TEST:
+            break
+        done.add(index)
+    return done
+
+# Generator skipping tests already finished in an earlier run
+# Args: tests - Iterable of (index, [request, host, port] + otherInfo) pairs
+#       done - DoneTests of finished tests
+def skipDone(tests,done):
+    for index,test in tests:
+        if not done.contains(index):
+            yield index,test
+
+
+# Class iterating the newline terminated lines of a binary file as strings,
+# counting the bytes read. A last line cut short by a crash is left out
+# Args: inFile - File opened in binary mode
+class CompleteLines:
+    def __init__(self,inFile):
+        self.inFile = inFile
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.inFile.readline()
+        if not line.endswith(b"\n"):
+            raise StopIteration
+        self.size += len(line)
+        return line.decode()
+
+
+# Method to cut the output and journal of an interrupted run back to the rows both hold
+# Rows are journaled in the order they are written, so the first n rows of the
+# csv are the first n records of the journal. A crash between the two flushes
+# leaves rows that would be probed and written again, or records whose rows
+# were lost, so both are trimmed to the shorter of the two
+# Args: journalFile - File name of the journal
+#       csvFile - File name of the csv the rows were streamed to
+#       header - True if the csv starts with a header line
+def trimResume(journalFile,csvFile,header):
+    if not os.path.exists(journalFile):
+        return
+    records = max((os.path.getsize(journalFile) - HEADER.size) // TEST_RECORD.size, 0)
+    rows = 0
+    size = 0
+    if os.path.exists(csvFile):
+        with open(csvFile,"rb") as csvIn:
+            lines = CompleteLines(csvIn)
+            if header:
+                next(lines,None)
+                size = lines.size
+            # csv pulls each line of a row, quoted newlines included, before yielding it
+            reader = csv.reader(lines)
+            for _ in reader:
+                if rows == records:
+                    break
+                rows += 1
+                size = lines.size
+    if os.path.exists(csvFile):
+        os.truncate(csvFile,size)
+    os.truncate(journalFile,min(HEADER.size + rows * TEST_RECORD.size,os.path.getsize(journalFile)))
+
+# Class appending finished probes to a journal
+# Args: journalFile - File name of the journal
+#       digest - fingerprint of the input and options, written at the head of a new journal
+#       resume - Append to an existing journal instead of starting a new one
+class Journal:
+    def __init__(self,journalFile,digest,resume=False):
+        self.journalFile = journalFile
+        self.file = open(journalFile,"ab" if resume else "wb",buffering=scanOutput.BUFFER_SIZE)
+        # The header goes to disk at once, so any journal left behind can be checked
+        if not resume or self.file.tell() == 0:
+            self.file.write(HEADER.pack(MAGIC,digest))
+            self.file.flush()
+
+    # Method to record a finished probe
+    # Args: index - Index of the test that produced the result
+    #       result - List of result values [request, host, port, result, ...]
+    def write(self,index,result):
+        # Every row written to the csv is journaled, other errors included, so
+        # a resume never writes a second row for a test
+        status = scanEngine.statusCode(result[3])
+        if status == None:
+            status = scanStore.STATUS_OTHER
+        self.file.write(TEST_RECORD.pack(TYPE_TEST,index,status))
+
+    # Method to push recorded probes to disk
+    def flush(self):
+        self.file.flush()
+
+    # Method to close the journal
+    # Args: complete - True if the scan finished, so there is nothing to resume
+    def close(self,complete=False):
+        self.file.close()
+        if complete:
+            os.remove(self.journalFile)
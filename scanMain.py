@@ -0,0 +1,303 @@
+# Author: Brenden Sweetman
+# Title: scanMain
+# Description: Command line, scan options and scan pipeline shared by portScanMT and portScanMTcsv
+
+
+import argparse
+import importlib
+import os
+import socket
+import time
+
+import scanBanner
+import scanCluster
+import scanDatabase
+import scanDedup
+import scanDiff
+import scanDiscovery
+import scanEngine
+import scanInput
+import scanJournal
+import scanMetrics
+import scanOutput
+import scanResolver
+import scanSchedule
+import scanShard
+import scanSocket
+import scanStore
+import scanTiming
+import scanTune
+
+
+# Method to build the command line parser shared by the scripts
+# Args: description - Description of the script
+#       separator - String between the ports of an input line
+def buildParser(description,separator):
+    parser = argparse.ArgumentParser(description=description)
+
+    # Parse the discovery ports up front, so a bad one stops the scan before it starts
+    def discoveryPorts(text):
+        try:
+            return scanInput.parsePorts(text,separator)
+        except ValueError as msg:
+            raise argparse.ArgumentTypeError("bad discovery ports {}: {}".format(text, msg))
+
+    parser.add_argument('input',help='Formated Input File')
+    parser.add_argument('output',help='Output File (CSV)')
+    parser.add_argument("-t","--timeout",help='Timeout to wait for reply (Seconds). Default 10 Seconds',type=int)
+    parser.add_argument("-p","--poolsize",help='Size of muti-threaded pool. Default 5 threads (1000 for the async engine)',type=int)
+    parser.add_argument("-e","--engine",help='Connect engine, thread pool or asyncio event loop. Default thread',choices=["thread","async"],default="thread")
+    parser.add_argument("-s","--sort",help='Rewrite output in input order once the scan completes. Default is completion order',action="store_true")
+    parser.add_argument("-r","--resume",help='Resume an interrupted scan, skipping probes listed in its journal (<output>.journal)',action="store_true")
+    parser.add_argument("--dns-ttl",help='Seconds to cache resolved hostnames. Default 300 Seconds',type=int)
+    parser.add_argument("-6","--ipv6",help='Resolve hostnames to IPv6 addresses too, not only IPv4',action="store_true")
+    parser.add_argument("-a","--adaptive",help='Adapt each timeout to the measured round trip time of the target subnet, capped at --timeout',action="store_true")
+    parser.add_argument("--min-timeout",help='Shortest adaptive timeout (Seconds). Default 0.05 Seconds',type=float)
+    parser.add_argument("-d","--discover",help='Probe each subnet and range address on these ports first and only scan hosts that answer. Default ports 22{0}80{0}443'.format(separator),type=discoveryPorts,nargs="?",const=scanInput.parsePorts(",".join(scanDiscovery.DISCOVERY_PORTS),","))
+    parser.add_argument("--auto",help='Tune the number of connects in flight to the completion rate, local errors and timeouts, starting from --poolsize',action="store_true")
+    parser.add_argument("--fast-close",help='Abort accepted connects with a RST (SO_LINGER 0) so they leave no TIME_WAIT entry',action="store_true")
+    parser.add_argument("--source",help='Comma separated local addresses to send probes from, in turn')
+    parser.add_argument("--source-ports",help='Range of local ports to send probes from, in turn (LOW-HIGH)',type=scanSocket.portRange)
+    parser.add_argument("-w","--workers",help='Number of processes to split the scan over, each with its own pool. Default 1',type=int,default=1)
+    parser.add_argument("--progress",help='Print a progress line to stderr every N Seconds. Default 5 Seconds',type=float,nargs="?",const=5)
+    parser.add_argument("--metrics-file",help='Write a JSON snapshot of the scan metrics to this file while scanning')
+    parser.add_argument("--metrics-port",help='Serve the scan metrics in Prometheus text format on localhost:PORT/metrics',type=int)
+    parser.add_argument("--db",help='Also write results to this SQLite database, keeping every scan and the last seen state of each host and port')
+    parser.add_argument("--diff",help='Only probe new targets, ports that were LISTENING and results older than --stale in these previous results (a --db database or results csv), writing changes to <output>.diff.csv')
+    parser.add_argument("--stale",help='Hours after which a previous result is probed again. Default 24 Hours',type=float,default=scanDiff.STALE_HOURS)
+    parser.add_argument("--banners",help='Connect again to each LISTENING port to read its banner and identify the service, adding Detected Service and Banner columns',action="store_true")
+    parser.add_argument("--banner-poolsize",help='Max banner grabs in flight. Default 32',type=int)
+    parser.add_argument("--banner-timeout",help='Time one banner grab may take (Seconds). Default 3 Seconds',type=float)
+    parser.add_argument("--summary",help='Keep results in a compact store and print per status and per port counts at the end',action="store_true")
+    parser.add_argument("--dedup",help='Test each (ip, port) covered by several input lines once and report it for every line',action="store_true")
+    parser.add_argument("--randomize",help='Test (ip, port) pairs in a random order, interleaving hosts',action="store_true")
+    parser.add_argument("--seed",help='Seed for --randomize to repeat an order',type=int)
+    parser.add_argument("--retries",help='Probe with a short timeout first, then retry FILTERED probes this many times, doubling the timeout up to --timeout on the last',type=int,default=0)
+    parser.add_argument("--first-timeout",help='Timeout of the first pass when retrying (Seconds). Default 1 Second',type=float)
+    parser.add_argument("--rate",help='Max probes per second overall',type=float)
+    parser.add_argument("--host-rate",help='Max probes per second to one host',type=float)
+    parser.add_argument("--subnet-rate",help='Max probes per second to one /24 (IPv6 /64)',type=float)
+    parser.add_argument("--coordinator",help='Hand the scan out in leased chunks to scanCluster.py workers connecting to HOST:PORT (HOST defaults to 127.0.0.1), merging their results here. Workers need the token in SCAN_CLUSTER_TOKEN, or the one printed at start')
+    parser.add_argument("--chunk-size",help='Tests in each chunk handed to a worker. Default 16384',type=scanCluster.chunkSize,default=scanCluster.CHUNK_TESTS)
+    parser.add_argument("--lease",help='Seconds a worker may hold a chunk without renewing before it is handed out again. Default 60 Seconds',type=float,default=scanCluster.LEASE_SECONDS)
+    return parser
+
+# Method to apply the scan options that live in shared module state
+# Args: args - Parsed command line arguments
+def configure(args):
+    # Turn on adaptive timeouts
+    scanTiming.RTT.enabled = args.adaptive
+    if args.min_timeout != None:
+        scanTiming.RTT.minTimeout = args.min_timeout
+    if args.dns_ttl != None:
+        scanResolver.CACHE.ttl = args.dns_ttl
+    # Resolve hostnames to either family
+    if args.ipv6:
+        scanResolver.CACHE.family = socket.AF_UNSPEC
+    # Tune the number of connects in flight, sharing the local ports between workers
+    scanTune.TUNER.enabled = args.auto
+    scanTune.TUNER.shares = args.workers
+    # Abort accepted connects and spread probes over source addresses and ports
+    scanSocket.SOCKETS.fastClose = args.fast_close
+    if args.source != None:
+        scanSocket.SOCKETS.sources = args.source.split(",")
+    if args.source_ports != None:
+        scanSocket.SOCKETS.ports = tuple(args.source_ports)
+
+# Method to run all connections, or one shard of them
+# Args: scriptName - Name of the script module giving getDestList, getIntervals, testPort and testArgs
+#       inList - list of split lines from input csv
+#       intervals - List of (request, start, end, ports, otherInfo) from getIntervals, or None to build it from inList
+#       args - Parsed command line arguments
+#       done - DoneTests of tests finished by an interrupted run, or None
+#       live - scanDiscovery.HostSet of live hosts from discovery, or None
+#       previous - scanDiff.Previous results to only probe what changed, or None
+#       chunk - (start, end) range of test indices leased from a coordinator, or None for every test
+#       callback - Function called with (index, result) as each test completes
+#       shard - Number of the shard to run
+#       workers - Total number of shards
+def runScan(scriptName,inList,intervals,args,done,live,previous,chunk,callback,shard=0,workers=1):
+    script = importlib.import_module(scriptName)
+    timeout = args.timeout
+    if intervals == None:
+        intervals = script.getIntervals(inList)
+    # Lazily generate all destination connections, or those of a leased chunk
+    # or shard, interleaving hosts in a random order if asked, counting them
+    # for progress. A shard only builds its own tests
+    if chunk != None:
+        destList = scanSchedule.rangeTests(intervals,chunk[0],chunk[1],args.randomize,args.seed)
+    elif args.randomize:
+        destList = scanSchedule.permuteTests(intervals,args.seed,shard,workers)
+    elif workers > 1:
+        destList = scanSchedule.shardTests(intervals,shard,workers)
+    else:
+        destList = enumerate(script.getDestList(inList))
+    destList = scanMetrics.METRICS.track(destList)
+    # Test each (ip, port) once, fanning its result out to every line covering it
+    targetIndex = scanDedup.TargetIndex(intervals) if args.dedup else None
+    if targetIndex != None:
+        callback = targetIndex.fanOut(callback)
+    # Identify the service on each LISTENING port in a stage of its own, once per (ip, port)
+    banners = None
+    if args.banners:
+        banners = scanBanner.BannerStage(callback,args.banner_poolsize,args.banner_timeout)
+        callback = banners.onResult
+    # Skip connections finished by an interrupted run
+    if done != None:
+        destList = scanJournal.skipDone(destList,done)
+    # Report dead hosts once instead of testing each of their ports
+    if live != None:
+        destList = scanDiscovery.skipDown(destList,live,callback,intervals)
+    # Only probe new targets, stale results and ports that were listening
+    if previous != None:
+        destList = previous.select(destList,args.stale * 3600)
+    if targetIndex != None:
+        destList = targetIndex.skipDuplicates(destList)
+    # Hold probes to the rate limits, split evenly over the shards
+    limiter = None
+    if args.rate or args.host_rate or args.subnet_rate:
+        limiter = scanSchedule.RateLimiter(*[rate / workers if rate else None for rate in (args.rate,args.host_rate,args.subnet_rate)])
+    # Probe everything with a short timeout first and only retry the FILTERED
+    # probes with longer ones, if asked
+    timeouts = scanSchedule.passTimeouts(timeout,args.first_timeout,args.retries) if args.retries else [timeout]
+    complete = False
+    try:
+        for passNumber,passTimeout in enumerate(timeouts):
+            # Hold back the FILTERED results of every pass but the last
+            retryQueue = scanSchedule.RetryQueue(callback) if passNumber < len(timeouts) - 1 else None
+            # Stretch adaptive timeouts on each retry too
+            scanTiming.RTT.backoff = 2 ** passNumber
+            runPass(script,destList,args,passTimeout,limiter,retryQueue.hold if retryQueue != None else callback)
+            if retryQueue == None or len(retryQueue) == 0:
+                break
+            destList = retryQueue.tests()
+        complete = True
+    finally:
+        # Wait for the banner grabs still running
+        if banners != None:
+            banners.close(complete)
+
+# Method to run one pass of connections through the connect engine
+# Args: script - Script module giving testPort and testArgs
+#       destList - Iterable of (index, [request, host, port] + otherInfo) pairs
+#       args - Parsed command line arguments
+#       timeout - Number of seconds to wait with no reply
+#       limiter - RateLimiter to hold probes to, or None
+#       callback - Function called with (index, result) as each test completes
+def runPass(script,destList,args,timeout,limiter,callback):
+    if limiter != None:
+        destList = scanSchedule.rateLimit(destList,limiter)
+    # Run all connections on one event loop with non-blocking sockets
+    if args.engine == "async":
+        scanEngine.runAsync(destList,timeout,args.poolsize,callback)
+    # Otherwise feed connections to the thread pool through a bounded queue,
+    # passing rate limit pauses through as they are
+    else:
+        scanEngine.runThreaded(script.testPort,((index,script.testArgs(test,timeout) if index != None else test) for index,test in destList),args.poolsize,callback)
+
+# Method to run a script from the command line
+# Args: scriptName - Name of the script module giving the headers, getDestList, getIntervals, testPort and testArgs
+#       description - Description of the script
+#       separator - String between the ports of an input line
+#       loadTargets - Function reading the input file into a list of split lines
+def main(scriptName,description,separator,loadTargets):
+    script = importlib.import_module(scriptName)
+    # Collect start time of script
+    startTime = time.time()
+    # Parse CMD line args
+    parser = buildParser(description,separator)
+    args = parser.parse_args()
+    # Workers only get the input lines of their chunk, so options needing the
+    # whole input or earlier results stay on one box
+    if args.coordinator != None and (args.dedup or args.discover != None or args.diff != None or args.resume):
+        parser.error("--coordinator can not be used with --dedup, --discover, --diff or --resume")
+    inFile = args.input
+    outFile = args.output
+    timeout = args.timeout
+    poolsize = args.poolsize
+    engine = args.engine
+
+    # Read from input file, keeping port ranges compact. The lines are held in
+    # memory on purpose: hostnames are resolved ahead of the scan, discovery
+    # walks them again and the coordinator sends each chunk its own lines
+    inList = loadTargets(inFile)
+    # Index the address intervals once, every stage finds tests by index in them
+    intervals = script.getIntervals(inList)
+    configure(args)
+    # Resolve each unique hostname once, ahead of any connect
+    scanResolver.resolveAll(inValue[0] for inValue in inList if not (scanInput.isHitlist(inValue[0]) or scanInput.RANGE.search(inValue[0]) or scanInput.SUBNET.search(inValue[0])))
+    # Load the probes finished by an interrupted run
+    journalFile = outFile + ".journal"
+    # A journal only exists while a scan is unfinished
+    resume = args.resume and os.path.exists(journalFile)
+    digest = scanJournal.fingerprint(scriptName,inFile,intervals,args)
+    done = None
+    if resume:
+        try:
+            scanJournal.checkJournal(journalFile,digest)
+        except ValueError as msg:
+            parser.error(str(msg))
+        # Drop rows and records an interrupted run only wrote to one of the two
+        scanJournal.trimResume(journalFile,scanOutput.streamPath(outFile,args.sort),not args.sort)
+        done = scanJournal.loadJournal(journalFile)
+        print("Resuming: skipping {} finished probes".format(done.count))
+    # Load the previous results to compare against
+    previous = None
+    report = None
+    if args.diff != None:
+        previous = scanDiff.loadPrevious(args.diff)
+        report = scanDiff.DiffReport(outFile + ".diff.csv",previous)
+        print("Differential scan against {} previous results".format(len(previous)))
+    # Find the live hosts of every subnet and range before scanning their ports
+    live = None
+    if args.discover != None:
+        live = scanDiscovery.runDiscovery(intervals,args.discover,engine,timeout,poolsize,done)
+    # Stream results to csv as they complete, journaling each finished probe
+    journal = scanJournal.Journal(journalFile,digest,resume)
+    output = scanOutput.CsvStream(outFile,script.BANNER_HEADER if args.banners else script.CSV_HEADER,args.sort,journal,resume)
+    # Keep every result and the last seen state of each (host, port) in SQLite
+    database = scanDatabase.Database(args.db,inFile,outFile,resume) if args.db != None else None
+    # Keep results compactly for the summary
+    store = scanStore.ResultStore() if args.summary else None
+    # Count every result as it is written
+    def record(index,result):
+        scanMetrics.METRICS.record(result)
+        if store != None:
+            store.append(result)
+        if database != None:
+            database.write(result)
+        if report != None:
+            report.record(result)
+        output.write(index,result)
+    # Report live metrics while the scan runs
+    scanMetrics.METRICS.reset(scanSchedule.getOffsets(intervals)[1])
+    reporter = None
+    if args.progress != None or args.metrics_file != None or args.metrics_port != None:
+        reporter = scanMetrics.Reporter(args.progress or 5,args.progress != None,args.metrics_file,args.metrics_port)
+    complete = False
+    try:
+        # Hand the connections out to worker nodes, merging their results
+        if args.coordinator != None:
+            scanCluster.runCoordinator(args.coordinator,scriptName,inList,intervals,args,record)
+        # Split the connections over several processes, merging their results
+        elif args.workers > 1:
+            scanShard.runSharded(runScan,(scriptName,inList,intervals,args,done,live,previous,None),args.workers,record,configure,(args,))
+        else:
+            runScan(scriptName,inList,intervals,args,done,live,previous,None,record)
+        complete = True
+    finally:
+        if reporter != None:
+            reporter.stop()
+        # Flush whatever completed, even if the scan was interrupted
+        output.close(complete)
+        if database != None:
+            database.close(complete)
+        if report != None:
+            report.close()
+    if store != None:
+        print(scanStore.summary(store))
+    if report != None:
+        print(report.summary())
+    # Report execution time
+    execTime = time.time() - startTime
+    print("Execution Time {:.2f} Seconds".format(execTime))
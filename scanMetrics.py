@@ -0,0 +1,235 @@
+# Author: Brenden Sweetman
+# Title: scanMetrics
+# Description: Live scan metrics with a progress line, JSON snapshots and a Prometheus endpoint
+
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds of the connect latency histogram buckets (Seconds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Class counting probes, results and connect latencies for one scan
+class ScanMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    # Method to clear every counter and start the clock
+    # Args: planned - Total number of tests in the scan, 0 if unknown
+    def reset(self,planned=0):
+        with self.lock:
+            self.startTime = time.monotonic()
+            self.planned = planned
+            self.expanded = 0
+            self.issued = 0
+            self.finished = 0
+            self.completed = 0
+            self.statuses = {}
+            self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+            self.latencySum = 0.0
+            # Probe counters already sent to the parent by a shard process
+            self.sent = self.counters()
+
+    # Method to get the probe counters as a flat list, lock must be held
+    def counters(self):
+        return [self.expanded, self.issued, self.finished, self.latencySum] + self.buckets
+
+    # Generator counting tests as the executors pull them from target expansion
+    # Args: tests - Iterable of tests
+    def track(self,tests):
+        for test in tests:
+            self.expanded += 1
+            yield test
+
+    # Method to count a probe starting its connect
+    def probeStarted(self):
+        with self.lock:
+            self.issued += 1
+
+    # Method to count a probe finishing its connect
+    # Args: latency - Seconds the probe took
+    def probeFinished(self,latency):
+        with self.lock:
+            self.finished += 1
+            self.latencySum += latency
+            for bucket,bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    self.buckets[bucket] += 1
+                    break
+            else:
+                self.buckets[-1] += 1
+
+    # Method to take the probe counters gathered since the last call
+    # A shard process sends these to the parent along with its results
+    def takeDeltas(self):
+        with self.lock:
+            counters = self.counters()
+            deltas = [now - before for now,before in zip(counters,self.sent)]
+            self.sent = counters
+            return deltas
+
+    # Method to add the probe counters of a shard process
+    # Args: deltas - List from takeDeltas in the shard
+    def merge(self,deltas):
+        with self.lock:
+            self.expanded += deltas[0]
+            self.issued += deltas[1]
+            self.finished += deltas[2]
+            self.latencySum += deltas[3]
+            for bucket,count in enumerate(deltas[4:]):
+                self.buckets[bucket] += count
+
+    # Method to count a result handed to the output
+    # Args: result - List of result values [request, host, port, result, ...]
+    def record(self,result):
+        status = str(result[3]).strip()
+        with self.lock:
+            self.completed += 1
+            self.statuses[status] = self.statuses.get(status,0) + 1
+
+    # Method to get a consistent copy of the metrics
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.startTime
+            # Shard processes send their counts with their results, so fall
+            # back to the results merged here until they arrive
+            progress = max(self.expanded, self.completed)
+            rate = progress / elapsed if elapsed > 0 else 0
+            eta = None
+            if self.planned and rate > 0:
+                eta = max(self.planned - progress, 0) / rate
+            cumulative = []
+            total = 0
+            for count in self.buckets:
+                total += count
+                cumulative.append(total)
+            return {
+                "elapsed": round(elapsed,3),
+                "planned": self.planned,
+                "expanded": self.expanded,
+                "issued": self.issued,
+                "inFlight": self.issued - self.finished,
+                "completed": self.completed,
+                "rate": round(rate,1),
+                "eta": round(eta,1) if eta != None else None,
+                "statuses": dict(self.statuses),
+                "latencyBuckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], cumulative)),
+                "latencySum": round(self.latencySum,6),
+                "latencyCount": self.finished,
+            }
+
+# Metrics shared by every scan in this process
+METRICS = ScanMetrics()
+
+
+# Method to format a snapshot as a one line progress report
+# Args: snapshot - Dictionary from ScanMetrics.snapshot
+def progressLine(snapshot):
+    line = "[{:.0f}s] {} tests".format(snapshot["elapsed"], max(snapshot["expanded"], snapshot["completed"]))
+    if snapshot["planned"]:
+        line += "/{} ({:.1f}%)".format(snapshot["planned"], 100 * max(snapshot["expanded"], snapshot["completed"]) / snapshot["planned"])
+    line += ", {} in flight, {}/s".format(snapshot["inFlight"], snapshot["rate"])
+    for status,count in sorted(snapshot["statuses"].items()):
+        line += ", {} {}".format(status, count)
+    if snapshot["eta"] != None:
+        eta = int(snapshot["eta"])
+        line += ", ETA {}:{:02}:{:02}".format(eta // 3600, eta // 60 % 60, eta % 60)
+    return line
+
+# Method to format a snapshot in the Prometheus text format
+# Args: snapshot - Dictionary from ScanMetrics.snapshot
+def prometheusText(snapshot):
+    lines = [
+        "# TYPE portscan_tests_planned gauge",
+        "portscan_tests_planned {}".format(snapshot["planned"]),
+        "# TYPE portscan_probes_issued_total counter",
+        "portscan_probes_issued_total {}".format(snapshot["issued"]),
+        "# TYPE portscan_probes_in_flight gauge",
+        "portscan_probes_in_flight {}".format(snapshot["inFlight"]),
+        "# TYPE portscan_results_total counter",
+    ]
+    for status,count in sorted(snapshot["statuses"].items()):
+        lines.append('portscan_results_total{{status="{}"}} {}'.format(status.replace('"',"'"), count))
+    lines.append("# TYPE portscan_connect_latency_seconds histogram")
+    for bound,count in snapshot["latencyBuckets"].items():
+        lines.append('portscan_connect_latency_seconds_bucket{{le="{}"}} {}'.format(bound, count))
+    lines.append("portscan_connect_latency_seconds_sum {}".format(snapshot["latencySum"]))
+    lines.append("portscan_connect_latency_seconds_count {}".format(snapshot["latencyCount"]))
+    if snapshot["eta"] != None:
+        lines.append("# TYPE portscan_eta_seconds gauge")
+        lines.append("portscan_eta_seconds {}".format(snapshot["eta"]))
+    return "\n".join(lines) + "\n"
+
+# Method to write a snapshot to a JSON file, replacing it atomically
+# Args: snapshot - Dictionary from ScanMetrics.snapshot
+#       path - File name of the JSON snapshot
+def writeSnapshot(snapshot,path):
+    with open(path + ".tmp","w") as snapshotFile:
+        json.dump(snapshot,snapshotFile)
+    os.replace(path + ".tmp",path)
+
+
+# Class serving METRICS on /metrics in the Prometheus text format
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheusText(METRICS.snapshot()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type","text/plain; version=0.0.4")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keep scrapes out of the progress output
+    def log_message(self,*args):
+        pass
+
+
+# Class reporting METRICS periodically from a background thread
+# Args: interval - Seconds between reports
+#       progress - Print a progress line to stderr on each report
+#       snapshotFile - Optional file name to write JSON snapshots to
+#       port - Optional localhost port to serve Prometheus text on
+class Reporter:
+    def __init__(self,interval,progress=False,snapshotFile=None,port=None):
+        self.interval = interval
+        self.progress = progress
+        self.snapshotFile = snapshotFile
+        self.stopped = threading.Event()
+        self.server = None
+        if port != None:
+            self.server = ThreadingHTTPServer(("127.0.0.1",port),MetricsHandler)
+            threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    # Method run in the reporter thread
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    # Method to report the current metrics once
+    def report(self):
+        snapshot = METRICS.snapshot()
+        if self.progress:
+            print(progressLine(snapshot),file=sys.stderr)
+        if self.snapshotFile != None:
+            writeSnapshot(snapshot,self.snapshotFile)
+
+    # Method to stop reporting, writing a final report
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
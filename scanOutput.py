@@ -0,0 +1,101 @@
+# Author: Brenden Sweetman
+# Title: scanOutput
+# Description: Streaming CSV output for the Multi-Threaded port scanners
+
+
+import csv
+import os
+import threading
+
+
+# Size of the write buffer on the output file (bytes)
+BUFFER_SIZE = 1 << 20
+# Max number of seconds a finished result may sit in the buffer
+FLUSH_SECONDS = 5
+
+
+# Class to write results to csv as they complete
+# Args: outFile - File name for output csv
+#       header - Header line for the csv
+#       sort - Rewrite the csv in test order once the scan is complete
+#       journal - Optional scanJournal.Journal recording each finished probe
+#       resume - Append to the csv of an interrupted run
+class CsvStream:
+    def __init__(self,outFile,header,sort=False,journal=None,resume=False):
+        self.outFile = outFile
+        self.header = header
+        self.sort = sort
+        self.journal = journal
+        self.path = streamPath(outFile,sort)
+        resume = resume and os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        self.file = open(self.path,"a" if resume else "w",newline="",buffering=BUFFER_SIZE)
+        self.writer = csv.writer(self.file,lineterminator="\n")
+        if not sort and not resume:
+            self.file.write(header)
+        # Results may be written from the pool and the main thread at once
+        self.lock = threading.Lock()
+        # Push buffered rows to disk on a timer, so rows finished before a
+        # quiet stretch are not held in the buffer until the next write
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.flushLoop,daemon=True)
+        self.flusher.start()
+
+    # Method to write one result
+    # Args: index - Index of the test that produced the result
+    #       result - List of result values
+    def write(self,index,result):
+        with self.lock:
+            if self.sort:
+                self.writer.writerow([index] + result)
+            else:
+                self.writer.writerow(result)
+            if self.journal != None:
+                self.journal.write(index,result)
+
+    # Method run in the flusher thread, pushing buffered rows to disk every
+    # FLUSH_SECONDS so a crash keeps them
+    def flushLoop(self):
+        while not self.stopped.wait(FLUSH_SECONDS):
+            with self.lock:
+                self.flush()
+
+    # Method to push buffered rows to disk
+    def flush(self):
+        self.file.flush()
+        # The journal is flushed after the csv so it never lists a probe
+        # whose row was lost
+        if self.journal != None:
+            self.journal.flush()
+
+    # Method to flush and close the csv, sorting it if requested
+    # Args: complete - True if every test finished. An interrupted run keeps
+    #                  its part file and journal so it can be resumed
+    def close(self,complete=True):
+        self.stopped.set()
+        self.flusher.join()
+        self.file.close()
+        if self.journal != None:
+            self.journal.close(complete)
+        if self.sort:
+            sortPart(self.path,self.outFile,self.header)
+            if complete:
+                os.remove(self.path)
+
+# Method to get the file results are streamed to
+# When sorting, stream to a part file tagged with the test index
+# Args: outFile - File name for output csv
+#       sort - Rewrite the csv in test order once the scan is complete
+def streamPath(outFile,sort):
+    return outFile + ".part" if sort else outFile
+
+# Method to rewrite an index tagged part file in test order
+# Args: partFile - File name of the index tagged csv
+#       outFile - File name for output csv
+#       header - Header line for the csv
+def sortPart(partFile,outFile,header):
+    with open(partFile,newline="") as inCsv:
+        rows = sorted(csv.reader(inCsv), key=lambda row: int(row[0]))
+    with open(outFile,"w",newline="",buffering=BUFFER_SIZE) as outCsv:
+        outCsv.write(header)
+        writer = csv.writer(outCsv,lineterminator="\n")
+        writer.writerows(row[1:] for row in rows)
@@ -0,0 +1,103 @@
+# Author: Brenden Sweetman
+# Title: scanResolver
+# Description: Shared DNS cache so each hostname is resolved once per scan
+
+
+import asyncio
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import scanAddress
+
+
+# Seconds a resolved hostname is kept in the cache
+DNS_TTL = 300
+# Seconds a hostname that could not be resolved is kept in the cache
+NEGATIVE_TTL = 60
+# Number of hostnames resolved at once by resolveAll
+RESOLVER_POOLSIZE = 16
+
+
+# Class caching hostname lookups with a TTL. Failed lookups are cached as None
+# Args: ttl - Seconds to keep a resolved hostname
+#       negativeTtl - Seconds to keep a hostname that could not be resolved
+class DnsCache:
+    def __init__(self,ttl=DNS_TTL,negativeTtl=NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        # Address family hostnames are resolved to, AF_UNSPEC for either in the system's order
+        self.family = socket.AF_INET
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # Method to look up a hostname without resolving it
+    # Returns (True, address) on a hit, address is None if the hostname could
+    # not be resolved. Returns (False, None) on a miss or expired entry
+    # Args: host - String of Hostname
+    def get(self,host):
+        entry = self.entries.get(host)
+        if entry == None or entry[1] < time.monotonic():
+            return False, None
+        return True, entry[0]
+
+    # Method to store the result of a lookup
+    # Args: host - String of Hostname
+    #       address - String of resolved IP, None if it could not be resolved
+    def put(self,host,address):
+        ttl = self.ttl if address != None else self.negativeTtl
+        with self.lock:
+            self.entries[host] = (address, time.monotonic() + ttl)
+
+# Cache shared by every scan in this process
+CACHE = DnsCache()
+
+
+# Method to resolve a hostname, None if it could not be resolved
+# Args: host - String of Hostname
+def resolveHost(host):
+    try:
+        return socket.getaddrinfo(host, None, CACHE.family, socket.SOCK_STREAM)[0][4][0]
+    except (socket.gaierror, UnicodeError):
+        return None
+
+# Method to get the address to connect to for a host, resolving on a cache miss
+# Returns None if the hostname could not be resolved
+# Args: host - String of Hostname or IP
+def getAddress(host):
+    if scanAddress.isAddress(host):
+        return host
+    hit,address = CACHE.get(host)
+    if not hit:
+        address = resolveHost(host)
+        CACHE.put(host,address)
+    return address
+
+# Coroutine to get the address to connect to for a host without blocking the event loop
+# Args: host - String of Hostname or IP
+async def asyncGetAddress(host):
+    if scanAddress.isAddress(host):
+        return host
+    hit,address = CACHE.get(host)
+    if not hit:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, None, family=CACHE.family, type=socket.SOCK_STREAM)
+            address = infos[0][4][0]
+        except (socket.gaierror, UnicodeError):
+            address = None
+        CACHE.put(host,address)
+    return address
+
+# Method to resolve every unique hostname concurrently ahead of the connect stage
+# Args: hosts - Iterable of Hostnames or IPs
+#       poolsize - Number of lookups to run at once. Default RESOLVER_POOLSIZE
+def resolveAll(hosts,poolsize=None):
+    hosts = [host for host in set(hosts) if not scanAddress.isAddress(host) and not CACHE.get(host)[0]]
+    if not hosts:
+        return
+    pool = ThreadPool(min(poolsize or RESOLVER_POOLSIZE, len(hosts)))
+    for host,address in zip(hosts, pool.imap(resolveHost,hosts)):
+        CACHE.put(host,address)
+    pool.close()
+    pool.join()
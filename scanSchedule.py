@@ -0,0 +1,284 @@
+# Author: Brenden Sweetman
+# Title: scanSchedule
+# Description: Host interleaved probe order, token bucket rate limits and retry passes for unanswered probes
+
+
+import bisect
+import heapq
+import random
+import threading
+import time
+from array import array
+
+import scanAddress
+import scanInput
+import scanStore
+
+
+# Max number of tests held back by per host or per subnet limits before waiting
+MAX_DEFERRED = 10000
+# Number of takes between sweeps of idle per host and per subnet buckets
+PRUNE_EVERY = 100000
+# Default timeout of the first pass when unanswered probes are retried (Seconds)
+FIRST_TIMEOUT = 1
+
+
+# Method to get the number of tests one input line expands to
+# Args: interval - (request, start, end, ports, otherInfo) from getIntervals
+def countTests(interval):
+    request,start,end,ports,otherInfo = interval
+    if isinstance(start,str):
+        return len(ports)
+    if isinstance(start,scanInput.Hitlist):
+        return len(start) * len(ports)
+    return max(end - start + 1, 0) * len(ports)
+
+# Method to get the index of the first test of each line and the total number of tests
+# Args: intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+def getOffsets(intervals):
+    offsets = []
+    total = 0
+    for interval in intervals:
+        offsets.append(total)
+        total += countTests(interval)
+    return offsets,total
+
+# Generator of the getDestList stream in a random order, without building it
+# A full period LCG over the next power of two is passed through a bijective
+# mix, and values past the end are skipped (cycle walking). Each test keeps
+# its index in the getDestList stream. A shard only permutes its own tests
+# Args: intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+#       seed - Optional seed for a reproducible order
+#       shard - Number of the shard to generate
+#       workers - Total number of shards, tests are dealt round robin by index
+def permuteTests(intervals,seed=None,shard=0,workers=1):
+    offsets,total = getOffsets(intervals)
+    # Number of tests dealt to this shard
+    count = max((total - shard + workers - 1) // workers, 0)
+    if count == 0:
+        return
+    rand = random.Random(seed)
+    bits = max((count - 1).bit_length(), 1)
+    mask = (1 << bits) - 1
+    mult = rand.randrange(0, 1 << bits, 4) + 1
+    step = rand.randrange(1, 1 << bits, 2)
+    mixMult = rand.randrange(1, 1 << bits, 2)
+    shift = max(bits // 2, 1)
+    value = rand.randrange(0, 1 << bits)
+    for _ in range(1 << bits):
+        value = (mult * value + step) & mask
+        number = ((value ^ (value >> shift)) * mixMult) & mask
+        if number < count:
+            index = shard + number * workers
+            yield index, getTest(intervals,offsets,index)
+
+# Generator of the tests of one shard of the getDestList stream, without
+# building the others. Tests are dealt round robin by index
+# Args: intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+#       shard - Number of the shard to generate
+#       workers - Total number of shards
+def shardTests(intervals,shard,workers):
+    offsets,total = getOffsets(intervals)
+    for index in range(shard,total,workers):
+        yield index, getTest(intervals,offsets,index)
+
+# Generator of the tests of one index range of the getDestList stream
+# Args: intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+#       start - Index of the first test
+#       end - Index after the last test
+#       shuffle - Test the range in a random order
+#       seed - Optional seed for a reproducible order
+def rangeTests(intervals,start,end,shuffle=False,seed=None):
+    offsets,total = getOffsets(intervals)
+    indices = range(start,min(end,total))
+    if shuffle:
+        indices = list(indices)
+        random.Random(None if seed == None else seed ^ start).shuffle(indices)
+    for index in indices:
+        yield index, getTest(intervals,offsets,index)
+
+# Method to build the test at one index of the getDestList stream
+# Args: intervals - List of (request, start, end, ports, otherInfo) from getIntervals
+#       offsets - Index of the first test of each line
+#       index - Index of the test
+def getTest(intervals,offsets,index):
+    lineId = bisect.bisect_right(offsets,index) - 1
+    request,start,end,ports,otherInfo = intervals[lineId]
+    hostNumber,portNumber = divmod(index - offsets[lineId], len(ports))
+    # Hostnames and single IPs are tested as written
+    if isinstance(start,str) or start == end and scanAddress.isAddress(request):
+        host = request
+    elif isinstance(start,scanInput.Hitlist):
+        host = start[hostNumber]
+    else:
+        host = scanAddress.toAddress(start + hostNumber)
+    return [request, host, ports[portNumber]] + list(otherInfo)
+
+
+# Class of a token bucket
+# Args: rate - Tokens added per second
+#       burst - Max number of tokens held
+class TokenBucket:
+    def __init__(self,rate,burst=None):
+        self.rate = rate
+        self.burst = burst if burst != None else max(rate, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    # Method to refill the bucket and get the seconds until a token is free
+    # Args: now - Current time.monotonic()
+    def wait(self,now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    # Method to use one token
+    def take(self):
+        self.tokens -= 1
+
+
+# Class holding the global, per host and per /24 (IPv6 /64) token buckets
+# Args: rate - Max probes per second overall, None for no limit
+#       hostRate - Max probes per second to one host, None for no limit
+#       subnetRate - Max probes per second to one /24 or IPv6 /64, None for no limit
+class RateLimiter:
+    def __init__(self,rate=None,hostRate=None,subnetRate=None):
+        self.globalBucket = TokenBucket(rate) if rate else None
+        self.hostRate = hostRate
+        self.subnetRate = subnetRate
+        self.hosts = {}
+        self.subnets = {}
+        self.takes = 0
+
+    # Method to get the buckets limiting one host
+    # Args: host - String of Hostname or IP
+    def getBuckets(self,host):
+        buckets = []
+        if self.hostRate:
+            bucket = self.hosts.get(host)
+            if bucket == None:
+                bucket = self.hosts[host] = TokenBucket(self.hostRate)
+            buckets.append(bucket)
+        if self.subnetRate:
+            number = scanAddress.toNumber(host)
+            subnet = scanAddress.subnetOf(number,24) if number != None else host
+            bucket = self.subnets.get(subnet)
+            if bucket == None:
+                bucket = self.subnets[subnet] = TokenBucket(self.subnetRate)
+            buckets.append(bucket)
+        return buckets
+
+    # Method to take a token for a probe of a host
+    # Returns 0 on success, or the seconds to wait before the host may be probed
+    # Args: host - String of Hostname or IP
+    #       now - Current time.monotonic()
+    def takeHost(self,host,now):
+        buckets = self.getBuckets(host)
+        wait = max([bucket.wait(now) for bucket in buckets] or [0])
+        if wait == 0:
+            for bucket in buckets:
+                bucket.take()
+            self.takes += 1
+            if self.takes % PRUNE_EVERY == 0:
+                self.prune(now)
+        return wait
+
+    # Method to take a token from the global bucket
+    # Returns 0 on success, or the seconds to wait
+    # Args: now - Current time.monotonic()
+    def takeGlobal(self,now):
+        if self.globalBucket == None:
+            return 0
+        wait = self.globalBucket.wait(now)
+        if wait == 0:
+            self.globalBucket.take()
+        return wait
+
+    # Method to drop buckets that have refilled, they are the same as new ones
+    # Args: now - Current time.monotonic()
+    def prune(self,now):
+        for buckets in (self.hosts, self.subnets):
+            for key in [key for key,bucket in buckets.items() if bucket.wait(now) == 0 and bucket.tokens >= bucket.burst]:
+                del buckets[key]
+
+
+# Generator applying rate limits to a stream of tests
+# Tests of a host or /24 over its limit are held back while other tests go
+# ahead. When the engine must wait it is handed (None, seconds) instead of a
+# test, so an event loop can sleep without blocking. This must be the last
+# stage before the engine
+# Args: tests - Iterable of (index, test) pairs
+#       limiter - RateLimiter to apply
+def rateLimit(tests,limiter):
+    deferred = []
+    sequence = 0
+    tests = iter(tests)
+    exhausted = False
+    while not exhausted or deferred:
+        now = time.monotonic()
+        # Retry the earliest held back test once its wait is over
+        if deferred and deferred[0][0] <= now:
+            _,_,index,test = heapq.heappop(deferred)
+        # Too many held back, wait for the earliest instead of pulling more
+        elif exhausted or len(deferred) >= MAX_DEFERRED:
+            yield None, deferred[0][0] - now
+            continue
+        else:
+            try:
+                index,test = next(tests)
+            except StopIteration:
+                exhausted = True
+                continue
+        wait = limiter.takeHost(test[1],now)
+        if wait > 0:
+            sequence += 1
+            heapq.heappush(deferred,(now + wait,sequence,index,test))
+            continue
+        wait = limiter.takeGlobal(now)
+        while wait > 0:
+            yield None, wait
+            wait = limiter.takeGlobal(time.monotonic())
+        yield index,test
+
+
+# Method to get the timeout of each pass of a scan retrying unanswered probes
+# The first pass is short, each retry doubles it and the last uses the full timeout
+# Args: timeout - Full timeout (Seconds), None for the default
+#       firstTimeout - Timeout of the first pass, None for FIRST_TIMEOUT
+#       retries - Number of passes after the first
+def passTimeouts(timeout,firstTimeout,retries):
+    timeout = timeout if timeout != None else 10
+    firstTimeout = min(firstTimeout if firstTimeout != None else FIRST_TIMEOUT, timeout)
+    return [min(firstTimeout * 2 ** number, timeout) for number in range(retries)] + [timeout]
+
+
+# Class holding back FILTERED results of a pass so they can be probed again
+# The tests are kept compactly in a ResultStore, other results go straight to callback
+# Args: callback - Function called with (index, result) for results that are not held
+class RetryQueue:
+    def __init__(self,callback):
+        self.callback = callback
+        self.store = scanStore.ResultStore()
+        self.indices = array("Q")
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.indices)
+
+    # Method to hold a FILTERED result, passing any other result on
+    # Args: index - Index of the test in the getDestList stream
+    #       result - List of result values [request, host, port, result] + otherInfo
+    def hold(self,index,result):
+        if result[3] != "FILTERED":
+            self.callback(index,result)
+            return
+        # Keep the index and its row together
+        with self.lock:
+            self.indices.append(index)
+            self.store.append(result)
+
+    # Generator of the held tests as (index, test) pairs
+    def tests(self):
+        for row,index in enumerate(self.indices):
+            result = self.store.row(row)
+            yield index, result[:3] + result[4:]
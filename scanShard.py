@@ -0,0 +1,129 @@
+# Author: Brenden Sweetman
+# Title: scanShard
+# Description: Multi-process sharded execution of one scan across all cores
+
+
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+import scanMetrics
+
+
+# Max number of results a worker sends to the parent at once
+BATCH_SIZE = 256
+# Max number of seconds a worker holds a partial batch
+BATCH_SECONDS = 1
+# Max number of batches waiting in the result queue
+QUEUE_BATCHES = 64
+
+
+# Class batching a worker's results onto the result queue
+# Each batch carries the probe counters and latencies gathered since the last,
+# so the parent's metrics cover the probes run in every worker
+# Args: resultQueue - multiprocessing Queue read by the parent
+class BatchSender:
+    def __init__(self,resultQueue):
+        self.resultQueue = resultQueue
+        self.batch = []
+        self.lastSend = time.monotonic()
+        # Results may come from the pool and the main thread at once
+        self.lock = threading.Lock()
+
+    # Method to add one result, sending the batch when it is full or old
+    # Args: index - Index of the test that produced the result
+    #       result - List of result values
+    def send(self,index,result):
+        with self.lock:
+            self.batch.append((index,result))
+            if len(self.batch) >= BATCH_SIZE or time.monotonic() - self.lastSend >= BATCH_SECONDS:
+                self.sendBatch()
+
+    # Method to send any waiting results
+    def flush(self):
+        with self.lock:
+            self.sendBatch()
+
+    # Method to put the waiting results on the queue, lock must be held
+    def sendBatch(self):
+        deltas = scanMetrics.METRICS.takeDeltas()
+        if self.batch or any(deltas):
+            self.resultQueue.put((self.batch,deltas))
+            self.batch = []
+        self.lastSend = time.monotonic()
+
+# Method run in each worker process
+# Args: scanFunc - Function scanning one shard, called as scanFunc(*scanArgs, callback, shard, workers)
+#       scanArgs - Tuple of arguments for scanFunc
+#       shard - Number of this shard
+#       workers - Total number of shards
+#       resultQueue - multiprocessing Queue read by the parent
+#       initializer - Optional function run first to set up module state
+#       initargs - Tuple of arguments for initializer
+def shardWorker(scanFunc,scanArgs,shard,workers,resultQueue,initializer,initargs):
+    sender = BatchSender(resultQueue)
+    stopped = threading.Event()
+
+    # Send the counters and any partial batch on time while no result comes in
+    def tick():
+        while not stopped.wait(BATCH_SECONDS):
+            sender.flush()
+
+    ticker = threading.Thread(target=tick,daemon=True)
+    ticker.start()
+    try:
+        if initializer != None:
+            initializer(*initargs)
+        scanFunc(*scanArgs,sender.send,shard,workers)
+        stopped.set()
+        ticker.join()
+        sender.flush()
+        # Tell the parent this shard is finished
+        resultQueue.put(None)
+    except BaseException:
+        stopped.set()
+        ticker.join()
+        sender.flush()
+        resultQueue.put(traceback.format_exc())
+
+# Method to run a scan split over several processes and merge the results
+# Args: scanFunc - Function scanning one shard, called as scanFunc(*scanArgs, callback, shard, workers)
+#       scanArgs - Tuple of picklable arguments for scanFunc
+#       workers - Number of processes
+#       callback - Function called with (index, result) for every result, in the parent
+#       initializer - Optional function run in each worker before scanning
+#       initargs - Tuple of arguments for initializer
+def runSharded(scanFunc,scanArgs,workers,callback,initializer=None,initargs=()):
+    resultQueue = multiprocessing.Queue(QUEUE_BATCHES)
+    processes = [multiprocessing.Process(target=shardWorker,
+                                         args=(scanFunc,scanArgs,shard,workers,resultQueue,initializer,initargs),
+                                         daemon=True)
+                 for shard in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        running = workers
+        while running:
+            try:
+                batch = resultQueue.get(timeout=1)
+            except queue.Empty:
+                # A worker that died without reporting would hang the merge
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise RuntimeError("Scan worker died unexpectedly")
+                continue
+            if batch == None:
+                running -= 1
+            elif isinstance(batch,str):
+                raise RuntimeError("Scan worker failed:\n" + batch)
+            else:
+                results,deltas = batch
+                scanMetrics.METRICS.merge(deltas)
+                for index,result in results:
+                    callback(index,result)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
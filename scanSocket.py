@@ -0,0 +1,148 @@
+# Author: Brenden Sweetman
+# Title: scanSocket
+# Description: Probe sockets with fast close, source address and port spreading, and local port exhaustion backoff
+
+
+import argparse
+import errno
+import itertools
+import socket
+import struct
+import sys
+import threading
+
+
+# Times a probe failing for lack of local resources is retried
+LOCAL_RETRIES = 3
+# Errors meaning this box ran out of descriptors, local ports or buffers
+LOCAL_ERRORS = frozenset((errno.EMFILE, errno.ENFILE, errno.EADDRNOTAVAIL, errno.ENOBUFS, errno.ENOMEM))
+# First and longest wait after a local resource error (Seconds)
+BACKOFF_BASE = 0.05
+BACKOFF_MAX = 5
+# Source ports tried before a bind gives up
+BIND_TRIES = 16
+# Ephemeral port range used when the system one can not be read
+DEFAULT_PORT_RANGE = (49152, 65535)
+# Let connect pick the source port of a socket bound to an address, so the
+# port only has to be unique per destination (Linux)
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, "IP_BIND_ADDRESS_NO_PORT", 24)
+
+
+# Method to test if a result is a local resource error
+# Args: result - Result list [request, host, port, result, ...] of a probe
+def isLocalError(result):
+    return isinstance(result[3], OSError) and result[3].errno in LOCAL_ERRORS
+
+# Method to parse a LOW-HIGH range of source ports, as an argparse type
+# Args: text - String of the range
+def portRange(text):
+    low,_,high = text.partition("-")
+    try:
+        low,high = int(low),int(high)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected LOW-HIGH, got " + repr(text))
+    if not 0 < low <= high <= 65535:
+        raise argparse.ArgumentTypeError("ports must be 0 < LOW <= HIGH <= 65535, got " + repr(text))
+    return (low, high)
+
+# Method to get the ephemeral port range connects use
+def systemPortRange():
+    try:
+        with open("/proc/sys/net/ipv4/ip_local_port_range") as rangeFile:
+            low,high = (int(value) for value in rangeFile.read().split())
+    except (OSError, ValueError):
+        low,high = DEFAULT_PORT_RANGE
+    return low,high
+
+
+# Class opening and closing probe sockets
+# A connected socket is closed with a normal FIN, leaving a TIME_WAIT entry on
+# this box for a minute. With fastClose it is aborted with a RST instead
+# (SO_LINGER 0) so the local port is free again at once. Sources and ports
+# spread the probes over several local addresses and a chosen source port range
+class SocketFactory:
+    def __init__(self):
+        self.fastClose = False
+        # Local addresses to bind probes to, in turn
+        self.sources = []
+        # (low, high) source ports to bind probes to, in turn, or None for the kernel's choice
+        self.ports = None
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # Local resource errors since the last probe that got a socket through
+        self.failures = 0
+
+    # Method to get the number of source (address, port) pairs probes can use
+    def capacity(self):
+        low,high = self.ports or systemPortRange()
+        return (high - low + 1) * max(len(self.sources), 1)
+
+    # Method to open a TCP socket for one probe
+    # Args: family - Socket family of the target, AF_INET or AF_INET6. Default AF_INET
+    def open(self,family=socket.AF_INET):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if self.sources or self.ports:
+                self.bind(sock)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    # Method to bind a socket to the next source address and port
+    # Args: sock - Socket to bind
+    def bind(self,sock):
+        turn = next(self.counter)
+        # Only sources of the socket's family can be bound
+        sources = [source for source in self.sources if (":" in source) == (sock.family == socket.AF_INET6)]
+        if sources:
+            source = sources[turn % len(sources)]
+        else:
+            source = "::" if sock.family == socket.AF_INET6 else "0.0.0.0"
+        if self.ports == None:
+            if sys.platform.startswith("linux"):
+                sock.setsockopt(socket.IPPROTO_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+            sock.bind((source,0))
+            return
+        # Ports left in TIME_WAIT by a normal close can be bound again
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        low,high = self.ports
+        for attempt in range(BIND_TRIES):
+            port = low + (turn + attempt) % (high - low + 1)
+            try:
+                sock.bind((source,port))
+                return
+            except OSError as err:
+                # Port still held by another probe, try the next one
+                if err.errno != errno.EADDRINUSE or attempt == BIND_TRIES - 1:
+                    raise
+
+    # Method to close a probe socket
+    # Args: sock - Socket to close
+    #       connected - True if the connect was accepted
+    def close(self,sock,connected):
+        if connected and self.fastClose:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            except OSError:
+                pass
+        sock.close()
+
+    # Method to get the seconds to wait before retrying a probe
+    # Waits double with each local resource error in a row and end at the first probe that gets through
+    # Args: result - Result list [request, host, port, result, ...] of the probe
+    def backoff(self,result):
+        if not isLocalError(result):
+            if self.failures:
+                with self.lock:
+                    self.failures = 0
+            return 0
+        with self.lock:
+            self.failures += 1
+            failures = self.failures
+        if failures == 1:
+            print("Out of local sockets ({}), backing off".format(result[3]), file=sys.stderr)
+        return min(BACKOFF_BASE * 2 ** min(failures - 1, 16), BACKOFF_MAX)
+
+# Socket factory shared by every scan in this process
+SOCKETS = SocketFactory()
@@ -0,0 +1,156 @@
+# Author: Brenden Sweetman
+# Title: scanStore
+# Description: Compact array backed result store for million row scans
+
+
+import csv
+import socket
+import threading
+from array import array
+
+import scanAddress
+import scanEngine
+
+
+# Status code of results that are other errors. Their text is kept in the side table
+STATUS_OTHER = 255
+# Bit set in the side table id of a row whose address is IPv6
+V6_ROW = 1 << 31
+
+
+# Class keeping results in parallel typed arrays, about 11 bytes per result
+# IPv4 is a uint32, port a uint16 and status a uint8 code from scanEngine.RESULTS.
+# IPv6 addresses take 16 more packed bytes each, the uint32 of the row holding
+# their position. The request, hostname, error text and other csv info of each
+# result are interned into a side table and referenced by a uint32
+class ResultStore:
+    def __init__(self):
+        self.ips = array("I")
+        self.ips6 = bytearray()
+        self.ports = array("H")
+        self.statuses = array("B")
+        self.metas = array("I")
+        # Side table of (request, hostname or None, error or None, otherInfo) tuples
+        self.metaTable = []
+        self.metaIndex = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.statuses)
+
+    # Method to get the side table id of a metadata tuple, adding it if new
+    # Args: meta - Tuple of (request, hostname or None, error or None, otherInfo)
+    def intern(self,meta):
+        metaId = self.metaIndex.get(meta)
+        if metaId == None:
+            metaId = self.metaIndex[meta] = len(self.metaTable)
+            self.metaTable.append(meta)
+        return metaId
+
+    # Method to add one result
+    # Args: result - List of result values [request, host, port, result] + otherInfo
+    def append(self,result):
+        ip = scanAddress.toNumber(result[1])
+        hostname = None
+        if ip == None:
+            ip = 0
+            hostname = result[1]
+        status = scanEngine.statusCode(result[3])
+        error = None
+        if status == None:
+            status = STATUS_OTHER
+            error = str(result[3])
+        # A host found down has no single port
+        port = 0 if status == scanEngine.HOST_DOWN else int(result[2])
+        with self.lock:
+            metaId = self.intern((result[0], hostname, error, tuple(result[4:])))
+            if scanAddress.isV6(ip):
+                metaId |= V6_ROW
+                self.ips6 += (ip - scanAddress.V6_OFFSET).to_bytes(16, "big")
+                ip = len(self.ips6) // 16 - 1
+            self.ips.append(ip)
+            self.ports.append(port)
+            self.statuses.append(status)
+            self.metas.append(metaId)
+
+    # Method to rebuild the result list of one row
+    # Args: index - Row number
+    def row(self,index):
+        metaId = self.metas[index]
+        request,hostname,error,otherInfo = self.metaTable[metaId & ~V6_ROW]
+        status = self.statuses[index]
+        if hostname != None:
+            host = hostname
+        elif metaId & V6_ROW:
+            position = self.ips[index] * 16
+            host = socket.inet_ntop(socket.AF_INET6, bytes(self.ips6[position:position + 16]))
+        else:
+            host = socket.inet_ntoa(self.ips[index].to_bytes(4, "big"))
+        port = "*" if status == scanEngine.HOST_DOWN else str(self.ports[index])
+        result = error if status == STATUS_OTHER else scanEngine.RESULTS[status]
+        return [request, host, port, result] + list(otherInfo)
+
+    # Generator of result lists
+    # Args: indices - Optional iterable of row numbers. Default every row
+    def rows(self,indices=None):
+        for index in (range(len(self)) if indices == None else indices):
+            yield self.row(index)
+
+    # Generator of the row numbers with a status
+    # Args: status - Status code from scanEngine.RESULTS or STATUS_OTHER
+    def find(self,status):
+        statuses = self.statuses.tobytes()
+        code = bytes([status])
+        index = statuses.find(code)
+        while index != -1:
+            yield index
+            index = statuses.find(code, index + 1)
+
+    # Method to count results per status code
+    def statusCounts(self):
+        statuses = self.statuses.tobytes()
+        return {status: statuses.count(bytes([status])) for status in set(statuses)}
+
+    # Method to count results per port
+    # Args: status - Optional status code to count. Default every status
+    def portCounts(self,status=None):
+        counts = {}
+        ports = self.ports if status == None else (self.ports[index] for index in self.find(status))
+        for port in ports:
+            counts[port] = counts.get(port,0) + 1
+        return counts
+
+    # Method to write rows to csv
+    # Args: outFile - File name for output csv
+    #       header - Header line for the csv
+    #       indices - Optional iterable of row numbers. Default every row
+    def export(self,outFile,header,indices=None):
+        with open(outFile,"w",newline="") as outCsv:
+            outCsv.write(header)
+            csv.writer(outCsv,lineterminator="\n").writerows(self.rows(indices))
+
+# Method to load the results of an earlier scan from its csv
+# Args: inFile - File name of a results csv
+def loadCsv(inFile):
+    store = ResultStore()
+    with open(inFile,newline="") as inCsv:
+        reader = csv.reader(inCsv)
+        # Skip header
+        next(reader,None)
+        for result in reader:
+            store.append(result)
+    return store
+
+# Method to format per status and per port counts of a store
+# Args: store - ResultStore to summarise
+def summary(store):
+    lines = ["{} results".format(len(store))]
+    for status,count in sorted(store.statusCounts().items()):
+        name = scanEngine.RESULTS[status].strip() if status != STATUS_OTHER else "Other errors"
+        lines.append("  {}: {}".format(name, count))
+    listening = store.portCounts(scanEngine.STATUS_CODES[" LISTENING"])
+    if listening:
+        lines.append("LISTENING per port:")
+        for port,count in sorted(listening.items()):
+            lines.append("  {}: {}".format(port, count))
+    return "\n".join(lines)
@@ -0,0 +1,75 @@
+# Author: Brenden Sweetman
+# Title: scanTiming
+# Description: Adaptive connect timeouts from measured round trip times
+
+
+import threading
+
+import scanAddress
+
+
+# Smoothing gains for the round trip time and its variance (RFC 6298)
+ALPHA = 1 / 8
+BETA = 1 / 4
+# Multiple of the variance added to the smoothed round trip time
+K = 4
+# Default shortest timeout handed to a probe (Seconds)
+MIN_TIMEOUT = 0.05
+# Default prefix length of the IPv4 subnets sharing one estimate
+PREFIX = 24
+
+
+# Class estimating a retransmission style timeout per subnet from connect round trip times
+# Both accepted and refused connects are a full round trip to the target, so both are sampled
+# Args: minTimeout - Shortest timeout handed to a probe
+#       prefix - Prefix length of the IPv4 subnets sharing one estimate
+#       prefix6 - Prefix length of the IPv6 subnets sharing one estimate
+class RttEstimator:
+    def __init__(self,minTimeout=MIN_TIMEOUT,prefix=PREFIX,prefix6=scanAddress.PREFIX6):
+        self.enabled = False
+        self.minTimeout = minTimeout
+        # Multiple of the estimate handed out, raised for retries of unanswered probes
+        self.backoff = 1
+        self.prefix = prefix
+        self.prefix6 = prefix6
+        # Subnet key -> [smoothed rtt, rtt variance]
+        self.subnets = {}
+        self.lock = threading.Lock()
+
+    # Method to get the subnet key of an address
+    # Args: address - String of IPv4 or IPv6 address
+    def key(self,address):
+        number = scanAddress.toNumber(address)
+        if number == None:
+            return address
+        return scanAddress.subnetOf(number,self.prefix,self.prefix6)
+
+    # Method to record the round trip time of a connect
+    # Args: address - String of IPv4 or IPv6 address
+    #       rtt - Seconds the connect took
+    def sample(self,address,rtt):
+        if not self.enabled:
+            return
+        key = self.key(address)
+        with self.lock:
+            estimate = self.subnets.get(key)
+            # First sample sets the variance to half the round trip time
+            if estimate == None:
+                self.subnets[key] = [rtt, rtt / 2]
+            else:
+                estimate[1] = (1 - BETA) * estimate[1] + BETA * abs(estimate[0] - rtt)
+                estimate[0] = (1 - ALPHA) * estimate[0] + ALPHA * rtt
+
+    # Method to get the timeout for a probe of an address
+    # Args: address - String of IPv4 or IPv6 address
+    #       maxTimeout - Timeout used when there is no estimate yet, and the ceiling
+    def timeout(self,address,maxTimeout):
+        if not self.enabled:
+            return maxTimeout
+        estimate = self.subnets.get(self.key(address))
+        if estimate == None:
+            return maxTimeout
+        return min(max((estimate[0] + K * estimate[1]) * self.backoff, self.minTimeout), maxTimeout)
+
+# Estimates shared by every scan in this process
+RTT = RttEstimator()
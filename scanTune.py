@@ -0,0 +1,180 @@
+# Author: Brenden Sweetman
+# Title: scanTune
+# Description: AIMD controller tuning the number of connects in flight to what the box and network sustain
+
+
+import asyncio
+import threading
+import time
+
+import scanSocket
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Seconds between window adjustments
+INTERVAL = 0.5
+# Completions needed before a window adjustment, unless the period runs 10 intervals
+MIN_SAMPLES = 16
+# Factor the window is cut by when the timeout ratio climbs as the rate falls
+DECREASE = 0.75
+# Rise in the timeout ratio from the last period that counts as congestion
+TIMEOUT_MARGIN = 0.05
+# Rise in the rate a slow start doubling must bring to keep doubling
+SLOW_START_GAIN = 1.1
+# Max number of connects in flight for each engine
+THREAD_CEILING = 512
+ASYNC_CEILING = 20000
+# File descriptors kept free for output, journal and the event loop
+FD_RESERVE = 64
+
+
+# Method to raise the soft open file limit to the hard limit
+# Returns the soft limit, or None where there is no such limit
+def raiseFileLimit():
+    if resource == None:
+        return None
+    soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return None if soft == resource.RLIM_INFINITY else soft
+
+
+# Class growing and shrinking the connect window AIMD style
+# The window doubles while each doubling raises the completion rate, then
+# grows by a fixed step each period. Local resource errors halve it and a
+# climbing timeout ratio with a falling rate cuts it by DECREASE. It never
+# passes the open file limit or the source ports probes can use
+class ConcurrencyTuner:
+    def __init__(self):
+        self.enabled = False
+        # Number of processes sharing this box's ephemeral ports
+        self.shares = 1
+        self.limit = 1
+        self.ceiling = 1
+        self.inFlight = 0
+        self.condition = threading.Condition()
+        # Futures of coroutines waiting for a slot
+        self.waiters = []
+
+    # Method to start tuning a scan
+    # Args: limit - Starting window
+    #       ceiling - Max window of the engine
+    def start(self,limit,ceiling):
+        caps = [ceiling, scanSocket.SOCKETS.capacity() // self.shares]
+        fileLimit = raiseFileLimit()
+        if fileLimit != None:
+            caps.append(fileLimit - FD_RESERVE)
+        with self.condition:
+            self.ceiling = max(min(caps), 1)
+            self.limit = max(min(limit, self.ceiling), 1)
+            self.step = max(self.limit // 4, 1)
+            self.slowStart = True
+            self.inFlight = 0
+            self.peak = 0
+            self.lastRate = 0
+            self.lastTimeoutRatio = None
+            self.resetPeriod(time.monotonic())
+
+    # Method to clear the counters of one adjustment period
+    # Args: now - Current time.monotonic()
+    def resetPeriod(self,now):
+        self.periodStart = now
+        self.completions = 0
+        self.timeouts = 0
+        self.localErrors = 0
+        self.peak = self.inFlight
+
+    # Method to wait for a slot in the window from a pool thread
+    def acquire(self):
+        with self.condition:
+            while self.inFlight >= self.limit:
+                self.condition.wait()
+            self.inFlight += 1
+            self.peak = max(self.peak, self.inFlight)
+
+    # Coroutine to wait for a slot in the window on the event loop
+    async def asyncAcquire(self):
+        while self.inFlight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        with self.condition:
+            self.inFlight += 1
+            self.peak = max(self.peak, self.inFlight)
+
+    # Method to free a slot in the window
+    def release(self):
+        with self.condition:
+            self.inFlight -= 1
+            self.condition.notify()
+        self.wake()
+
+    # Method to wake the coroutines waiting for a slot
+    def wake(self):
+        waiters,self.waiters = self.waiters,[]
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    # Method to count a finished probe, adjusting the window once per period
+    # Returns True if the probe failed for lack of local resources
+    # Args: result - Result list [request, host, port, result, ...] of the probe
+    def observe(self,result):
+        localError = scanSocket.isLocalError(result)
+        with self.condition:
+            self.completions += 1
+            if result[3] == "FILTERED":
+                self.timeouts += 1
+            if localError:
+                self.localErrors += 1
+                # Back off at once instead of waiting for the period to end
+                self.decrease(0.5)
+                self.resetPeriod(time.monotonic())
+                return True
+            now = time.monotonic()
+            elapsed = now - self.periodStart
+            if elapsed >= INTERVAL and self.completions >= MIN_SAMPLES or elapsed >= 10 * INTERVAL:
+                self.adjust(now,elapsed)
+        return False
+
+    # Method to cut the window
+    # Args: factor - Fraction of the window kept
+    def decrease(self,factor):
+        self.limit = max(int(self.limit * factor), 1)
+        self.slowStart = False
+
+    # Method to adjust the window from the rate and timeout ratio of the last period
+    # Args: now - Current time.monotonic()
+    #       elapsed - Seconds in the period
+    def adjust(self,now,elapsed):
+        rate = self.completions / elapsed
+        timeoutRatio = self.timeouts / self.completions if self.completions else 0
+        if (self.lastTimeoutRatio != None and timeoutRatio > self.lastTimeoutRatio + TIMEOUT_MARGIN
+                and rate < self.lastRate):
+            # More probes are timing out and fewer finish, so the path is congested
+            self.decrease(DECREASE)
+        elif self.peak < self.limit:
+            # The window was never full, so it is not what limits the rate
+            pass
+        elif self.slowStart:
+            if rate < self.lastRate * SLOW_START_GAIN:
+                self.slowStart = False
+            self.limit = min(self.limit * 2 if self.slowStart else self.limit + self.step, self.ceiling)
+        else:
+            self.limit = min(self.limit + self.step, self.ceiling)
+        self.lastRate = rate
+        self.lastTimeoutRatio = timeoutRatio
+        self.resetPeriod(now)
+        self.condition.notify_all()
+        self.wake()
+
+# Tuner shared by every scan in this process
+TUNER = ConcurrencyTuner()